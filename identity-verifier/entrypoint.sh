@@ -1,7 +1,6 @@
 #!/bin/sh
 
 echo "Applying database migrations..."
-python manage.py makemigrations
 python manage.py migrate
 echo "Migrations done"
 
@@ -0,0 +1,58 @@
+import gc
+import os
+import shutil
+import tempfile
+
+# The app, and with it the OCR and face models, is loaded once in the master and shared by the forked workers.
+# Each worker warms the models up after forking.
+os.environ.setdefault("MODEL_WARM_UP", "post_fork")
+
+# Each worker writes its metrics to files in this directory, which /metrics sums up. They are reset at every start.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "identity-verifier-metrics"))
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+bind = "0.0.0.0:8000"
+timeout = 120
+# Threads keep status streams and slow requests from holding a whole worker
+worker_class = "gthread"
+threads = 8
+preload_app = True
+
+
+def when_ready(server):
+    from django import db
+
+    from identity_verifier_app.face_index import get_face_index
+
+    # Rebuilt from the database once at startup; the workers only append the verifications stored since
+    try:
+        get_face_index().rebuild()
+    except Exception as e:
+        server.log.warning(f"Cannot rebuild the face index: {str(e)}")
+    finally:
+        # The workers must not share the master's database connection
+        db.connections.close_all()
+
+    # Keeps the garbage collector from writing to the objects loaded so far, so that their pages stay shared
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from identity_verifier_app.inference import models
+
+    models.warm_up_in_background()
+
+
+def worker_exit(server, worker):
+    from identity_verifier_app.audit import get_audit_log
+
+    # Verification records still queued are written, or spooled, before the worker goes
+    get_audit_log().close()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # The gauges of a worker that is gone no longer count
+    multiprocess.mark_process_dead(worker.pid)
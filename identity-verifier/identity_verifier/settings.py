@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -168,3 +170,100 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# Portrait handoff from the portrait capturer
+# Directory shared with the portrait capturer (its PORTRAIT_HANDOFF_DIR). Unset disables portrait tokens.
+PORTRAIT_HANDOFF_DIR = os.environ.get("PORTRAIT_HANDOFF_DIR")
+PORTRAIT_HANDOFF_TTL_SECONDS = float(os.environ.get("PORTRAIT_HANDOFF_TTL_SECONDS", 120))
+
+
+# Verification pipeline
+# Uploaded images are scaled down so that their longest side is at most this many pixels (0 for no limit)
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", 1600))
+# Threads running the OCR and face encoding stages of verifications concurrently
+VERIFICATION_WORKERS = int(os.environ.get("VERIFICATION_WORKERS", os.cpu_count() or 1))
+# "layout" reads only the regions of a located ID card, falling back to full-page OCR; "full" always reads the whole page
+OCR_MODE = os.environ.get("OCR_MODE", "layout")
+if OCR_MODE not in ("layout", "full"):
+    raise ValueError(f"OCR_MODE must be 'layout' or 'full', not {OCR_MODE!r}")
+# Read the machine-readable zone first, and skip the rest of the OCR when its check digits validate
+MRZ_FAST_PATH = os.environ.get("MRZ_FAST_PATH", "1") != "0"
+
+# Result cache of OCR output and face encodings, keyed by image content, for users retrying with the same upload.
+# Cached results are personal data: they are deleted this long after being computed, even if still in use.
+# 0 disables the cache.
+VERIFICATION_CACHE_TTL_SECONDS = float(os.environ.get("VERIFICATION_CACHE_TTL_SECONDS", 900))
+VERIFICATION_CACHE_MAX_BYTES = int(os.environ.get("VERIFICATION_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Directory for a disk tier shared by all worker processes. Unset keeps the cache in memory only.
+VERIFICATION_CACHE_DIR = os.environ.get("VERIFICATION_CACHE_DIR")
+
+
+# Verification jobs (api/verification-jobs/)
+# Threads running queued verifications, and how many verifications may be queued or running at once per process
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 32))
+JOB_RETRY_AFTER_SECONDS = int(os.environ.get("JOB_RETRY_AFTER_SECONDS", 5))
+# Finished jobs, whose results hold personal data, are forgotten after this long
+JOB_RESULT_TTL_SECONDS = float(os.environ.get("JOB_RESULT_TTL_SECONDS", 300))
+# How long a status stream stays open at most
+JOB_STREAM_TIMEOUT_SECONDS = float(os.environ.get("JOB_STREAM_TIMEOUT_SECONDS", 60))
+# Directory shared by all worker processes, so that any of them can report on a job. Unset keeps jobs in memory.
+JOB_DIR = os.environ.get("JOB_DIR")
+
+
+# Models
+# Processes that do not verify identities, such as the rollup scheduler, can skip loading the OCR and face models
+LOAD_MODELS = os.environ.get("LOAD_MODELS", "1") != "0"
+# When the OCR and face models are warmed up: "ready" right after loading them, "post_fork" in every Gunicorn worker
+# after it is forked from a master that loaded them (set by gunicorn.conf.py). /api/ready/ answers 503 until then.
+MODEL_WARM_UP = os.environ.get("MODEL_WARM_UP", "ready")
+if MODEL_WARM_UP not in ("ready", "post_fork"):
+    raise ValueError(f"MODEL_WARM_UP must be 'ready' or 'post_fork', not {MODEL_WARM_UP!r}")
+
+
+# Face encoding
+# Times face detection upsamples an image to find smaller faces; each pass is about four times slower
+FACE_DETECTION_UPSAMPLE = int(os.environ.get("FACE_DETECTION_UPSAMPLE", 1))
+# Times each face is re-sampled and encoded, averaging the results; slower but slightly more accurate
+FACE_ENCODING_JITTERS = int(os.environ.get("FACE_ENCODING_JITTERS", 1))
+
+
+# Duplicate identities
+# Portraits of passing verifications are searched against the face encodings of all past ones
+FACE_INDEX_DIR = os.environ.get("FACE_INDEX_DIR", os.path.join(tempfile.gettempdir(), "identity-verifier-face-index"))
+# Lists of the face index a search reads, out of 1024, once the index holds 50000 faces. More finds more of the
+# matches that lie across list boundaries, at a proportional cost; 0 compares every face, exactly but slowly.
+FACE_INDEX_PROBES = int(os.environ.get("FACE_INDEX_PROBES", 32))
+if FACE_INDEX_PROBES < 0:
+    raise ValueError(f"FACE_INDEX_PROBES must be 0 or more, not {FACE_INDEX_PROBES}")
+# Largest face encoding distance at which two verifications are taken to be of the same person. Stricter than the
+# document-to-portrait match, since portraits taken live are more alike than a portrait and a document photo.
+DUPLICATE_FACE_TOLERANCE = float(os.environ.get("DUPLICATE_FACE_TOLERANCE", 0.45))
+# What happens when a face was already verified under another name: "flag" records it on the verification,
+# "reject" also fails the verification
+DUPLICATE_IDENTITY_ACTION = os.environ.get("DUPLICATE_IDENTITY_ACTION", "flag")
+if DUPLICATE_IDENTITY_ACTION not in ("flag", "reject"):
+    raise ValueError(f"DUPLICATE_IDENTITY_ACTION must be 'flag' or 'reject', not {DUPLICATE_IDENTITY_ACTION!r}")
+
+
+# Audit log of verifications
+# Verification records are written in the background, in batches of AUDIT_BATCH_SIZE or every
+# AUDIT_FLUSH_INTERVAL_SECONDS. At most AUDIT_QUEUE_SIZE records wait in memory per process.
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", 1000))
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", 100))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.environ.get("AUDIT_FLUSH_INTERVAL_SECONDS", 1))
+# Records the database does not take, or that do not fit in the queue, are kept here until it does. It holds
+# personal data and must persist across restarts, outside the source tree so that it never ends up in an image.
+AUDIT_SPOOL_DIR = os.environ.get("AUDIT_SPOOL_DIR", "/var/lib/identity-verifier/audit-spool")
+
+
+# Analytics
+# How long a transaction writing verification records may take to commit. The rollups look at every verification
+# stored in the last ROLLUP_SETTLE_SECONDS again on each update, so that records committed late are counted too.
+ROLLUP_SETTLE_SECONDS = float(os.environ.get("ROLLUP_SETTLE_SECONDS", 300))
+
+
+# Metrics (/metrics)
+# Share of verification requests whose stage timings are logged in full, from 0 (none) to 1 (all)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
@@ -0,0 +1,145 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+from typing import List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Trunc, TruncHour, TruncMonth
+from django.utils import timezone
+
+from .models import ExpiryRollup, HourlyRollup, RollupState, Verification
+
+logger = logging.getLogger("IdentityVerifier")
+
+INTERVALS = ("hour", "day")
+
+
+def _hour_runs(hours: List[datetime]) -> List[Tuple[datetime, datetime]]:
+    """
+    Sorted hours merged into (<start>, <end>) ranges of consecutive hours.
+    """
+    runs = []
+    for hour in hours:
+        if runs and runs[-1][1] == hour:
+            runs[-1] = (runs[-1][0], hour + timedelta(hours=1))
+        else:
+            runs.append((hour, hour + timedelta(hours=1)))
+    return runs
+
+
+def update_rollups() -> int:
+    """
+    Brings the rollups up to date with the verifications stored since the last update.
+
+    Every hour holding a new verification, and only those, is recomputed as a whole from the indexed Verification
+    table, and its rollup rows are replaced, so that records written late (e.g. replayed from the audit spool) are
+    counted in their hour without double counting.
+
+    Verification IDs are assigned on insert, but concurrent writers commit in any order, so a record may become
+    visible after records with higher IDs. The verifications looked at are therefore those after the last ID that
+    had already been seen ROLLUP_SETTLE_SECONDS ago, and any transaction committing within that time is counted.
+
+    Returns the number of verifications looked at.
+    """
+    with transaction.atomic():
+        # Concurrent updates wait for each other
+        state = RollupState.objects.select_for_update().get_or_create(pk=1)[0]
+        now = timezone.now()
+        verifications = Verification.objects.filter(id__gt=state.last_verification_id)
+        new = verifications.aggregate(last_id=Max("id"), count=Count("id"))
+        hours = verifications.annotate(hour=TruncHour("timestamp")).values_list("hour", flat=True)
+        for start, end in _hour_runs(list(hours.distinct().order_by("hour"))):
+            _recompute(start, end)
+
+        if state.seen_at is not None and now - state.seen_at >= timedelta(seconds=settings.ROLLUP_SETTLE_SECONDS):
+            # Every record up to the ID seen then had committed before this update, which looked at it
+            state.last_verification_id = state.seen_verification_id
+            state.seen_at = None
+        if state.seen_at is None and new["last_id"] is not None and new["last_id"] > state.last_verification_id:
+            state.seen_verification_id, state.seen_at = new["last_id"], now
+        state.updated_at = now
+        state.save()
+    return new["count"]
+
+
+def _recompute(start: datetime, end: datetime):
+    """
+    Replaces the rollup rows of the hours from `start` to `end` with counts from the Verification table.
+    """
+    verifications = Verification.objects.filter(timestamp__gte=start, timestamp__lt=end)
+
+    hourly = Counter()
+    for row in (
+        verifications.annotate(hour=TruncHour("timestamp"))
+        .values("hour", "passed", "message")
+        .annotate(count=Count("id"))
+    ):
+        hourly[(row["hour"], row["passed"], row["message"] or "")] += row["count"]
+    expiry = (
+        verifications.filter(passed=True, document_expiration_date__isnull=False)
+        .annotate(hour=TruncHour("timestamp"), expiry_month=TruncMonth("document_expiration_date"))
+        .values("hour", "expiry_month")
+        .annotate(count=Count("id"))
+    )
+
+    HourlyRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+    HourlyRollup.objects.bulk_create(
+        HourlyRollup(hour=hour, passed=passed, message=message, count=count)
+        for (hour, passed, message), count in hourly.items()
+    )
+    ExpiryRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+    ExpiryRollup.objects.bulk_create(
+        ExpiryRollup(hour=row["hour"], expiry_month=row["expiry_month"], count=row["count"]) for row in expiry
+    )
+    logger.info(f"Recomputed the rollups from {start} to {end}")
+
+
+def report(start: datetime, end: datetime, interval: str = "hour") -> dict:
+    """
+    Verification statistics between `start` and `end`, read from the rollups only: pass and fail counts, rejection
+    reasons, volume per `interval` ("hour" or "day") and the months in which verified documents expire.
+    """
+    hourly = HourlyRollup.objects.filter(hour__gte=start, hour__lt=end)
+
+    totals = {passed: count for passed, count in hourly.values_list("passed").annotate(count=Sum("count"))}
+    passed, failed = totals.get(True, 0), totals.get(False, 0)
+
+    volume = {}
+    for row in (
+        hourly.annotate(period=Trunc("hour", interval))
+        .values("period", "passed")
+        .annotate(count=Sum("count"))
+        .order_by("period")
+    ):
+        counts = volume.setdefault(row["period"], {"passed": 0, "failed": 0})
+        counts["passed" if row["passed"] else "failed"] = row["count"]
+
+    state = RollupState.objects.filter(pk=1).first()
+    return {
+        "from": start,
+        "to": end,
+        "updated_at": state.updated_at if state is not None else None,
+        "totals": {
+            "verifications": passed + failed,
+            "passed": passed,
+            "failed": failed,
+            "pass_rate": passed / (passed + failed) if passed + failed else None,
+        },
+        "rejection_reasons": [
+            {"message": message, "count": count}
+            for message, count in hourly.filter(passed=False)
+            .values_list("message")
+            .annotate(count=Sum("count"))
+            .order_by("-count", "message")
+        ],
+        "volume": [{interval: period, **counts} for period, counts in volume.items()],
+        "document_expiry": [
+            {"month": month.strftime("%Y-%m"), "count": count}
+            for month, count in ExpiryRollup.objects.filter(hour__gte=start, hour__lt=end)
+            .values_list("expiry_month")
+            .annotate(count=Sum("count"))
+            .order_by("expiry_month")
+        ],
+    }
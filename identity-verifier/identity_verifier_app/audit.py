@@ -0,0 +1,250 @@
+import atexit
+import fcntl
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from typing import List
+
+from django import db
+from django.conf import settings
+from django.core import serializers
+
+from .metrics import AUDIT_FLUSH_SECONDS, AUDIT_QUEUE_DEPTH, AUDIT_RECORDS
+from .models import Verification
+from .utils import atomic_write, lazy
+
+logger = logging.getLogger("IdentityVerifier")
+
+
+class AuditLog:
+    """
+    Writes Verification records in the background, so that no request waits for the database.
+
+    Records wait in a queue of at most `max_pending` and are written with one bulk_create per `batch_size`
+    records, or after `flush_interval` seconds for fewer. A batch the database does not take is spooled to
+    `spool_directory` and written again once the database is back, as is any record arriving while the queue is
+    full. Spool files are deleted only after their records are written, so every record is written at least once,
+    also across restarts, as long as the process exits gracefully (see close).
+
+    A batch the database refuses for its content (e.g. a name too long for its column) is written again one record
+    at a time. The records it still refuses are moved to the `quarantine` subdirectory of `spool_directory`, since
+    retrying them would never succeed, and are logged as errors.
+    """
+
+    # Spooled batches are retried at most this often while the queue is idle
+    RETRY_INTERVAL = 30
+
+    def __init__(self, max_pending: int, batch_size: int, flush_interval: float, spool_directory: str):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_directory = spool_directory
+        self.written = 0
+        self.spooled = 0
+        self.overflowed = 0
+        self.quarantined = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = None
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_retry = 0.0
+        self.quarantine_directory = os.path.join(spool_directory, "quarantine")
+        os.makedirs(self.quarantine_directory, exist_ok=True)
+
+    def record(self, verification: Verification):
+        """
+        Queues a record to be written. Never blocks: when the queue is full, the record is spooled to disk.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait(verification)
+            AUDIT_QUEUE_DEPTH.set(self._queue.qsize())
+        except queue.Full:
+            with self._lock:
+                self.overflowed += 1
+            self._spool([verification])
+
+    def _start(self):
+        # Started on first use, like the objects of utils.lazy
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+            elif time.monotonic() - self._last_retry >= self.RETRY_INTERVAL:
+                self._retry_spooled()
+        db.connections.close_all()
+
+    def _take_batch(self) -> List[Verification]:
+        """
+        Waits for a first record, then for more until the batch is full or `flush_interval` has passed.
+        """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        AUDIT_QUEUE_DEPTH.set(self._queue.qsize())
+        return batch
+
+    def _flush(self, batch: List[Verification]):
+        started = time.perf_counter()
+        try:
+            self._write(batch)
+        except Exception as e:
+            # Records written one at a time before the failure have their ID
+            batch = [verification for verification in batch if verification.pk is None]
+            logger.warning(f"Failed to write {len(batch)} verification records to database, spooling them: {str(e)}")
+            with self._lock:
+                self.failed_flushes += 1
+            self._spool(batch)
+            return
+        with self._lock:
+            self.last_flush_seconds = time.perf_counter() - started
+        AUDIT_FLUSH_SECONDS.observe(self.last_flush_seconds)
+        self._retry_spooled()
+
+    def _write(self, batch: List[Verification]):
+        """
+        Writes a batch, falling back to one record at a time if the database refuses it for its content, and
+        quarantines the records it still refuses. Raises if the database cannot be written to at all.
+        """
+        # The connection may have gone stale while the queue was idle
+        db.close_old_connections()
+        try:
+            Verification.objects.bulk_create(batch)
+            written = len(batch)
+        except (db.DataError, db.IntegrityError) as e:
+            logger.warning(
+                f"Database refused a batch of {len(batch)} verification records, writing them one by one: {str(e)}"
+            )
+            refused = []
+            for verification in batch:
+                try:
+                    Verification.objects.bulk_create([verification])
+                except (db.DataError, db.IntegrityError) as e:
+                    logger.error(f"Database refused verification record of {verification.timestamp}: {str(e)}")
+                    refused.append(verification)
+            self._quarantine(refused)
+            written = len(batch) - len(refused)
+        with self._lock:
+            self.written += written
+        AUDIT_RECORDS.labels("database").inc(written)
+
+    def _save(self, batch: List[Verification], directory: str):
+        # Names sort by age
+        with atomic_write(os.path.join(directory, f"{time.time_ns()}-{secrets.token_hex(4)}.json")) as f:
+            serializers.serialize("json", batch, stream=f)
+
+    def _spool(self, batch: List[Verification]):
+        try:
+            self._save(batch, self.spool_directory)
+        except OSError as e:
+            logger.error(f"Lost {len(batch)} verification records, cannot spool them: {str(e)}")
+            return
+        with self._lock:
+            self.spooled += len(batch)
+        AUDIT_RECORDS.labels("spool").inc(len(batch))
+
+    def _quarantine(self, batch: List[Verification]):
+        if not batch:
+            return
+        try:
+            self._save(batch, self.quarantine_directory)
+        except OSError as e:
+            logger.error(f"Lost {len(batch)} refused verification records, cannot quarantine them: {str(e)}")
+            return
+        logger.error(f"Quarantined {len(batch)} refused verification records in {self.quarantine_directory}")
+        with self._lock:
+            self.quarantined += len(batch)
+        AUDIT_RECORDS.labels("quarantine").inc(len(batch))
+
+    def _spool_files(self) -> List[str]:
+        return sorted(
+            entry.path for entry in os.scandir(self.spool_directory) if entry.name.endswith(".json")
+        )
+
+    def _retry_spooled(self):
+        """
+        Writes the spooled batches, oldest first, until the database cannot be written to.
+        """
+        self._last_retry = time.monotonic()
+        for path in self._spool_files():
+            try:
+                with open(path) as f:
+                    # Other worker processes sharing the directory may be replaying the same files
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    if not os.path.exists(path):
+                        continue
+                    batch = [item.object for item in serializers.deserialize("json", f)]
+                    self._write(batch)
+                    os.unlink(path)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning(f"Spooled verification records still cannot be written: {str(e)}")
+                return
+            logger.info(f"Wrote {len(batch)} spooled verification records")
+
+    def close(self):
+        """
+        Writes every queued record, to the database or to the spool, and stops the background thread.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        if thread is not None:
+            thread.join()
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(batch), self.batch_size):
+            self._flush(batch[start : start + self.batch_size])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._queue.qsize(),
+                "max_pending": self._queue.maxsize,
+                "written": self.written,
+                "spooled": self.spooled,
+                "overflowed": self.overflowed,
+                "quarantined": self.quarantined,
+                "failed_flushes": self.failed_flushes,
+                "spool_files": len(self._spool_files()),
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+
+@lazy
+def get_audit_log() -> AuditLog:
+    audit_log = AuditLog(
+        settings.AUDIT_QUEUE_SIZE,
+        settings.AUDIT_BATCH_SIZE,
+        settings.AUDIT_FLUSH_INTERVAL_SECONDS,
+        settings.AUDIT_SPOOL_DIR,
+    )
+    atexit.register(audit_log.close)
+    return audit_log
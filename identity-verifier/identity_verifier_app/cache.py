@@ -0,0 +1,224 @@
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from django.conf import settings
+
+from .metrics import CACHE_LOOKUPS
+from .utils import atomic_write, lazy
+
+logger = logging.getLogger("IdentityVerifier")
+
+
+class ResultCache:
+    """
+    Results of the expensive verification steps, keyed by the content of the image they were computed from, so that
+    a user retrying with the same upload does not pay for OCR and face encoding again.
+
+    Entries live in memory, least recently used first out once `max_bytes` is exceeded, and optionally in
+    `directory`, which several worker processes may share. Values must be JSON serializable.
+
+    The cached results are personal data (names, face encodings), so every entry expires `ttl` seconds after it
+    was computed, in both tiers, whether or not it is still being used. Images themselves are never cached. Keys
+    are HMACs of the image digest under the project's SECRET_KEY, so the file names do not tell whether a given
+    image was verified.
+    """
+
+    # Expired files are looked for at most this often
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, ttl: float, max_bytes: int, directory: Optional[str] = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def key(namespace: str, digest: str) -> str:
+        message = f"{namespace}:{digest}".encode()
+        return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+    def get(self, namespace: str, digest: str):
+        key = self.key(namespace, digest)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.labels("hit").inc()
+                    return entry[2]
+                self._remove(key)
+                self.expirations += 1
+
+        found = self._read_file(key, now)
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            self.disk_hits += 1
+            CACHE_LOOKUPS.labels("disk_hit").inc()
+            value, size, expires_at = found
+            self._store(key, value, size, expires_at)
+        return value
+
+    def contains(self, namespace: str, digest: Optional[str]) -> bool:
+        """
+        Whether an unexpired result is cached for an image, without reading it or counting a lookup.
+        """
+        if digest is None or not self.enabled:
+            return False
+        key = self.key(namespace, digest)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return True
+        if not self.directory:
+            return False
+        try:
+            return os.path.getmtime(self._path(key)) + self.ttl > now
+        except OSError:
+            return False
+
+    def put(self, namespace: str, digest: str, value):
+        key = self.key(namespace, digest)
+        data = json.dumps(value)
+        with self._lock:
+            self._store(key, value, len(data), time.time() + self.ttl)
+        self._write_file(key, data)
+
+    def _store(self, key, value, size, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get_or_compute(
+        self,
+        namespace: str,
+        digest: Optional[str],
+        compute: Callable[[], object],
+        dump: Callable[[object], object] = lambda result: result,
+        load: Callable[[object], object] = lambda value: value,
+    ):
+        """
+        Returns the cached result for an image, or computes and caches it. `dump` and `load` convert between the
+        result and its JSON serializable form. Images without a digest are never cached.
+        """
+        if digest is None or not self.enabled:
+            return compute()
+        value = self.get(namespace, digest)
+        if value is not None:
+            return load(value)
+        result = compute()
+        self.put(namespace, digest, dump(result))
+        return result
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_file(self, key, now):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            # Expiry counts from when the result was computed, not from when this worker first read it
+            expires_at = os.path.getmtime(path) + self.ttl
+            if expires_at <= now:
+                os.unlink(path)
+                return None
+            with open(path) as f:
+                data = f.read()
+            return json.loads(data), len(data), expires_at
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot read cached result {path}: {str(e)}")
+            return None
+
+    def _write_file(self, key, data):
+        if not self.directory:
+            return
+        try:
+            with atomic_write(self._path(key)) as f:
+                f.write(data)
+        except OSError as e:
+            logger.warning(f"Cannot write cached result: {str(e)}")
+        self.prune()
+
+    def prune(self):
+        """
+        Deletes the expired files of the disk tier.
+        """
+        now = time.time()
+        if not self.directory or now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime + self.ttl <= now:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.directory:
+            for entry in os.scandir(self.directory):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+@lazy
+def get_result_cache() -> ResultCache:
+    return ResultCache(
+        settings.VERIFICATION_CACHE_TTL_SECONDS,
+        settings.VERIFICATION_CACHE_MAX_BYTES,
+        settings.VERIFICATION_CACHE_DIR,
+    )
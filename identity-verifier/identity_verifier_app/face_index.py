@@ -0,0 +1,279 @@
+import fcntl
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import FACE_INDEX_ROWS
+from .models import Verification
+from .utils import lazy
+
+logger = logging.getLogger("IdentityVerifier")
+
+ENCODING_SIZE = 128
+# Rows read from the database at a time when catching up or rebuilding
+FETCH_SIZE = 50000
+# Lists the encodings are clustered into once the index holds FETCH_SIZE rows when rebuilt (see FaceIndex.search)
+LISTS = 1024
+# k-means iterations when fitting the lists
+LIST_ITERATIONS = 10
+# Seconds between database checks for newer verifications when searching (see FaceIndex.catch_up)
+CATCH_UP_INTERVAL = 1.0
+
+
+class FaceIndex:
+    """
+    Face encodings of past passing verifications, searchable 1:N.
+
+    The encodings are a float32 matrix in `directory`, memory-mapped by every worker process, with the squared
+    norm and the verification ID of every row alongside. Whichever process first sees newer verifications in the
+    database appends them, under a file lock. Distances are computed as |a - b|^2 = |a|^2 - 2 a.b + |b|^2 with the
+    precomputed norms.
+
+    Comparing a face with every row reads the whole matrix, about 0.1 s per million rows. So when the index is
+    rebuilt with enough rows, the encodings are clustered into LISTS lists by k-means, and every row records its
+    list. A search then compares the face only with the rows of the `probes` lists whose centroids are closest to
+    it. This is approximate: a match just across the boundary of a list that is not probed is missed. `probes=0`
+    compares every row.
+
+    The files of a build live in a generation directory that the `current` symlink points to, so a rebuild
+    replaces the whole index at once, and processes still mapping the previous generation move on at their next
+    search.
+    """
+
+    def __init__(self, directory: str, probes: int = 0):
+        self.directory = directory
+        self.probes = probes
+        self.rebuild_seconds = None
+        self._checked = None
+        self._generation = None
+        self._rows = 0
+        self._centroids = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+        self._lists = np.empty(0, dtype=np.int32)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return self._rows
+
+    @contextmanager
+    def _file_lock(self):
+        with open(os.path.join(self.directory, "index.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _current(self):
+        path = os.path.join(self.directory, "current")
+        if not os.path.exists(path):
+            return None
+        generation = os.path.realpath(path)
+        # Generations built before the encodings were clustered are rebuilt
+        return generation if os.path.exists(os.path.join(generation, "centroids.f32")) else None
+
+    @staticmethod
+    def _committed_rows(generation):
+        # IDs are written last, so their count is the number of complete rows
+        return os.path.getsize(os.path.join(generation, "ids.i64")) // 8
+
+    def _remap(self):
+        """
+        Maps the rows of the current generation that are not mapped yet.
+        """
+        generation = self._current()
+        if generation is None:
+            return
+        rows = self._committed_rows(generation)
+        if generation == self._generation and rows == self._rows:
+            return
+        if generation != self._generation:
+            centroids = np.fromfile(os.path.join(generation, "centroids.f32"), dtype=np.float32)
+            self._centroids = centroids.reshape(-1, ENCODING_SIZE)
+        if rows == 0:
+            ids = np.empty(0, dtype=np.int64)
+            encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            norms = np.empty(0, dtype=np.float32)
+            lists = np.empty(0, dtype=np.int32)
+        else:
+            ids = np.memmap(os.path.join(generation, "ids.i64"), dtype=np.int64, mode="r", shape=(rows,))
+            encodings = np.memmap(
+                os.path.join(generation, "encodings.f32"), dtype=np.float32, mode="r", shape=(rows, ENCODING_SIZE)
+            )
+            norms = np.memmap(os.path.join(generation, "norms.f32"), dtype=np.float32, mode="r", shape=(rows,))
+            lists = np.memmap(os.path.join(generation, "lists.i32"), dtype=np.int32, mode="r", shape=(rows,))
+        self._generation, self._rows = generation, rows
+        self._ids, self._encodings, self._norms, self._lists = ids, encodings, norms, lists
+        FACE_INDEX_ROWS.set(rows)
+
+    @staticmethod
+    def _fetch(after_id: int):
+        """
+        The next rows with a face encoding, by ascending ID: (<IDs>, <encodings>).
+        """
+        rows = list(
+            Verification.objects.filter(id__gt=after_id, face_encoding__isnull=False)
+            .order_by("id")
+            .values_list("id", "face_encoding")[:FETCH_SIZE]
+        )
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        encodings = np.frombuffer(b"".join(bytes(row[1]) for row in rows), dtype=np.float32)
+        return ids, encodings.reshape(-1, ENCODING_SIZE)
+
+    @staticmethod
+    def _nearest(encodings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """
+        The index of the closest centroid to every encoding.
+        """
+        if len(centroids) == 0:
+            return np.zeros(len(encodings), dtype=np.int32)
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+        nearest = np.empty(len(encodings), dtype=np.int32)
+        for start in range(0, len(encodings), 4096):
+            chunk = encodings[start : start + 4096]
+            nearest[start : start + len(chunk)] = np.argmin(centroid_norms - 2 * (chunk @ centroids.T), axis=1)
+        return nearest
+
+    @staticmethod
+    def _fit_lists(encodings: np.ndarray) -> np.ndarray:
+        """
+        LISTS centroids clustering `encodings`, by k-means. No centroids when there are too few encodings for the
+        lists to pay off.
+        """
+        if len(encodings) < FETCH_SIZE:
+            return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        rng = np.random.default_rng(0)
+        centroids = encodings[rng.choice(len(encodings), LISTS, replace=False)].copy()
+        for _ in range(LIST_ITERATIONS):
+            nearest = FaceIndex._nearest(encodings, centroids)
+            counts = np.bincount(nearest, minlength=LISTS)
+            # Lists left empty keep their centroid
+            filled = counts > 0
+            # Sums the encodings of every list as one contiguous run of the encodings sorted by list
+            starts = (np.cumsum(counts) - counts)[filled]
+            sums = np.add.reduceat(encodings[np.argsort(nearest, kind="stable")], starts, axis=0)
+            centroids[filled] = sums / counts[filled, None]
+        return centroids
+
+    @staticmethod
+    def _append(generation, centroids, ids, encodings):
+        rows = FaceIndex._committed_rows(generation)
+        for name, values, row_size in (
+            ("encodings.f32", encodings, ENCODING_SIZE * 4),
+            ("norms.f32", np.einsum("ij,ij->i", encodings, encodings), 4),
+            ("lists.i32", FaceIndex._nearest(encodings, centroids), 4),
+            ("ids.i64", ids, 8),
+        ):
+            with open(os.path.join(generation, name), "ab") as f:
+                # Drops whatever an interrupted append left past the last complete row
+                f.truncate(rows * row_size)
+                f.write(np.ascontiguousarray(values).tobytes())
+
+    def catch_up(self, interval: float = 0):
+        """
+        Adds the verifications stored since the index was last extended, by any process.
+
+        The rows other processes appended are mapped every time, but the database is only checked for newer
+        verifications if it was last checked at least `interval` seconds ago.
+        """
+        with self._lock:
+            self._remap()
+            if self._generation is None:
+                self._rebuild()
+                return
+            now = time.monotonic()
+            if self._checked is not None and now - self._checked < interval:
+                return
+            self._checked = now
+            after_id = int(self._ids[-1]) if self._rows else 0
+            if not Verification.objects.filter(id__gt=after_id, face_encoding__isnull=False).exists():
+                return
+            with self._file_lock():
+                self._remap()
+                after_id = int(self._ids[-1]) if self._rows else 0
+                while True:
+                    ids, encodings = self._fetch(after_id)
+                    if len(ids) == 0:
+                        break
+                    self._append(self._generation, self._centroids, ids, encodings)
+                    after_id = int(ids[-1])
+                self._remap()
+
+    def rebuild(self):
+        """
+        Builds the index from scratch from the database, e.g. at startup.
+        """
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        started = time.perf_counter()
+        self._checked = time.monotonic()
+        with self._file_lock():
+            generation = tempfile.mkdtemp(dir=self.directory, prefix="generation-")
+            for name in ("encodings.f32", "norms.f32", "lists.i32", "ids.i64"):
+                open(os.path.join(generation, name), "wb").close()
+            ids, encodings = self._fetch(0)
+            # Fitted on the first rows only, which stand for the later ones well enough
+            centroids = self._fit_lists(encodings)
+            centroids.tofile(os.path.join(generation, "centroids.f32"))
+            while len(ids):
+                self._append(generation, centroids, ids, encodings)
+                ids, encodings = self._fetch(int(ids[-1]))
+
+            # The symlink is swapped atomically; processes still mapping the old generation keep their files open
+            current = os.path.join(self.directory, "current")
+            previous = os.path.realpath(current) if os.path.exists(current) else None
+            link = os.path.join(self.directory, f"current.{secrets.token_hex(4)}")
+            os.symlink(generation, link)
+            os.replace(link, current)
+            if previous is not None and previous != generation:
+                shutil.rmtree(previous, ignore_errors=True)
+            self._remap()
+        self.rebuild_seconds = time.perf_counter() - started
+        logger.info(f"Face index rebuilt with {self._rows} encodings in {self.rebuild_seconds:.2f} s")
+
+    def search(self, encoding: np.ndarray, tolerance: float) -> List[Tuple[int, float]]:
+        """
+        Verifications whose face is within `tolerance` of `encoding`, as (<verification ID>, <distance>), closest
+        first. Verifications stored less than CATCH_UP_INTERVAL seconds ago may be missing.
+        """
+        self.catch_up(CATCH_UP_INTERVAL)
+        with self._lock:
+            centroids, lists = self._centroids, self._lists
+            ids, encodings, norms = self._ids, self._encodings, self._norms
+        if len(ids) == 0:
+            return []
+        query = np.asarray(encoding, dtype=np.float32)
+        if 0 < self.probes < len(centroids):
+            centroid_distances = np.einsum("ij,ij->i", centroids, centroids) - 2 * (centroids @ query)
+            probed = np.zeros(len(centroids), dtype=bool)
+            probed[np.argpartition(centroid_distances, self.probes)[: self.probes]] = True
+            rows = np.flatnonzero(probed[lists])
+            distances = norms[rows] - 2 * (encodings[rows] @ query) + query @ query
+        else:
+            rows = np.arange(len(ids))
+            distances = norms - 2 * (encodings @ query) + query @ query
+        matches = np.flatnonzero(distances <= tolerance**2)
+        order = matches[np.argsort(distances[matches])]
+        return [(int(ids[rows[i]]), float(np.sqrt(max(distances[i], 0.0)))) for i in order]
+
+    def stats(self):
+        return {"rows": self._rows, "rebuild_seconds": self.rebuild_seconds}
+
+
+@lazy
+def get_face_index() -> FaceIndex:
+    return FaceIndex(settings.FACE_INDEX_DIR, settings.FACE_INDEX_PROBES)
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+import re
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("IdentityVerifier")
+
+# Tokens are produced by secrets.token_urlsafe(32) in the portrait capturer
+TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+
+def valid_portrait_token(token) -> bool:
+    return bool(settings.PORTRAIT_HANDOFF_DIR) and isinstance(token, str) and bool(TOKEN_PATTERN.match(token))
+
+
+def _take_metadata(path: str) -> dict:
+    try:
+        with open(path) as f:
+            metadata = json.load(f)
+        os.unlink(path)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot read handed-off portrait metadata: {str(e)}")
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def take_portrait(token: str) -> Optional[Tuple[np.ndarray, dict]]:
+    """
+    Reads and removes the RGB portrait the portrait capturer stored under `token`, and the metadata stored with
+    it, such as the `face_location` it found.
+
+    Returns None if the token is unknown or the portrait has expired.
+    """
+    if not valid_portrait_token(token):
+        return None
+    path = os.path.join(settings.PORTRAIT_HANDOFF_DIR, f"{token}.npy")
+    metadata = _take_metadata(os.path.join(settings.PORTRAIT_HANDOFF_DIR, f"{token}.json"))
+    try:
+        expired = time.time() - os.path.getmtime(path) > settings.PORTRAIT_HANDOFF_TTL_SECONDS
+        portrait = None if expired else np.load(path, allow_pickle=False)
+        os.unlink(path)
+    except FileNotFoundError:
+        logger.warning("Handed-off portrait not found")
+        return None
+    if portrait is None:
+        logger.warning("Handed-off portrait has expired")
+        return None
+    return portrait, metadata
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("IdentityVerifier")
+
+
+def memory_usage() -> Optional[dict]:
+    """
+    Resident memory of this process and the part of it shared with other processes, such as model weights shared
+    by Gunicorn workers forked from a preloading master. None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            _, resident, shared = (int(value) for value in f.read().split()[:3])
+    except (OSError, ValueError):
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    return {"rss_bytes": resident * page_size, "shared_bytes": shared * page_size}
+
+
+class InferenceModels:
+    """
+    The OCR and face models of the process, loaded once and warmed up before the process reports ready.
+
+    Loading runs in AppConfig.ready. With Gunicorn preloading the app, that is in the master process, so workers
+    forked from it share the model weights copy-on-write instead of each loading their own copy. Warm-up runs one
+    inference through every model, so that no user request pays for first-use initialization. It runs in each
+    worker after the fork, since the inference libraries' thread pools do not survive forking.
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.load_seconds = {}
+        self.warm_up_seconds = {}
+        self.error = None
+        self._warm = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.reader is not None
+
+    @property
+    def ready(self) -> bool:
+        return self._warm.is_set()
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+            try:
+                started = time.perf_counter()
+                # Importing face_recognition loads dlib's face detector, landmark and encoding models
+                import face_recognition  # noqa: F401
+
+                self.load_seconds["face"] = time.perf_counter() - started
+
+                import easyocr
+
+                started = time.perf_counter()
+                self.reader = easyocr.Reader(["en"])
+                self.load_seconds["ocr"] = time.perf_counter() - started
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"Error loading models: {e}")
+                return
+        logger.info(f"Models loaded in {', '.join(f'{k} {v:.2f} s' for k, v in self.load_seconds.items())}")
+
+    def warm_up(self):
+        if not self.loaded:
+            return
+        import face_recognition
+
+        try:
+            # A synthetic document with a line of text and a face-sized region
+            image = np.full((240, 480, 3), 230, dtype=np.uint8)
+            cv2.putText(image, "IDROU WARM<<UP", (10, 200), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+            cv2.circle(image, (100, 90), 60, (160, 120, 100), -1)
+
+            started = time.perf_counter()
+            self.reader.readtext(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY))
+            self.warm_up_seconds["ocr"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            face_recognition.face_locations(image)
+            # Known locations make the landmark and encoding models run even though no real face is found
+            face_recognition.face_encodings(image, known_face_locations=[(30, 160, 150, 40)])
+            self.warm_up_seconds["face"] = time.perf_counter() - started
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Error warming up models: {e}")
+            return
+        self._warm.set()
+        logger.info(f"Models warmed up in {', '.join(f'{k} {v:.2f} s' for k, v in self.warm_up_seconds.items())}")
+
+    def warm_up_in_background(self):
+        threading.Thread(target=self.warm_up, name="model-warm-up", daemon=True).start()
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "loaded": self.loaded,
+            "load_seconds": {k: round(v, 3) for k, v in self.load_seconds.items()},
+            "warm_up_seconds": {k: round(v, 3) for k, v in self.warm_up_seconds.items()},
+            "memory": memory_usage(),
+            "error": self.error,
+        }
+
+
+models = InferenceModels()
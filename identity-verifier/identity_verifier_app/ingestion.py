@@ -0,0 +1,109 @@
+import hashlib
+from io import BytesIO
+import logging
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger("IdentityVerifier")
+
+# Smallest face, in pixels, worth encoding from a location found upstream
+MIN_FACE_SIDE = 32
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class IngestedImage:
+    """
+    An uploaded image, decoded once and shared by every verification step.
+
+    `rgb` feeds face_recognition and `gray` feeds OCR. `gray` is read-only. `rgb` is left writeable because
+    dlib's numpy bridge rejects read-only buffers, but it must not be modified either. `digest` identifies the
+    image content for the result cache, None for images not worth caching. `face_location` is where the only
+    face of the image is, as (top, right, bottom, left), when it was found upstream.
+    """
+
+    def __init__(
+        self, rgb: np.ndarray, digest: Optional[str] = None, face_location: Optional[Tuple[int, int, int, int]] = None
+    ):
+        self.rgb = rgb
+        self.digest = digest
+        self.face_location = face_location
+        self.gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        self.gray.flags.writeable = False
+
+    @property
+    def shape(self):
+        return self.rgb.shape
+
+
+def _limit_size(image: Image.Image, max_side: int) -> Image.Image:
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    return image
+
+
+def ingest_upload(file, max_side: int = None) -> IngestedImage:
+    """
+    Decodes an uploaded image file, applies its EXIF orientation and scales it down so that its longest side is
+    at most `max_side` pixels (settings.MAX_IMAGE_SIDE by default, 0 for no limit).
+    """
+    if max_side is None:
+        max_side = settings.MAX_IMAGE_SIDE
+    data = file.read()
+    try:
+        image = Image.open(BytesIO(data))
+        if max_side and max(image.size) > max_side:
+            # Lets the JPEG decoder skip detail we would throw away, decoding at 1/2, 1/4 or 1/8 scale
+            ratio = max_side / max(image.size)
+            image.draft("RGB", (int(image.width * ratio), int(image.height * ratio)))
+        image = ImageOps.exif_transpose(image)
+        image = _limit_size(image.convert("RGB"), max_side)
+    # Images of more than twice Image.MAX_IMAGE_PIXELS are refused before they are decoded
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImage(f"Cannot decode image: {e}") from e
+    # The decoded pixels depend on the size limit too
+    digest = f"{hashlib.sha256(data).hexdigest()}-{max_side}"
+    return IngestedImage(np.array(image), digest)
+
+
+def _checked_face_location(location, scale: float, shape) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Scales a (top, right, bottom, left) face location found on the original image, and checks that it is a
+    plausible face box within the image. Returns None otherwise.
+    """
+    try:
+        top, right, bottom, left = (int(round(float(v) * scale)) for v in location)
+    except (TypeError, ValueError):
+        return None
+    height, width = shape[:2]
+    top, left = max(top, 0), max(left, 0)
+    bottom, right = min(bottom, height), min(right, width)
+    face_height, face_width = bottom - top, right - left
+    if min(face_height, face_width) < MIN_FACE_SIDE or not 0.5 <= face_width / face_height <= 2:
+        return None
+    return top, right, bottom, left
+
+
+def ingest_array(rgb: np.ndarray, max_side: int = None, face_location=None) -> IngestedImage:
+    """
+    Wraps an already decoded RGB image, such as a portrait handed off by the portrait capturer. Such images are
+    captured afresh for every attempt, so they get no digest. A `face_location` found upstream is kept if it
+    passes a sanity check.
+    """
+    if max_side is None:
+        max_side = settings.MAX_IMAGE_SIDE
+    original_height = rgb.shape[0]
+    if max_side and max(rgb.shape[:2]) > max_side:
+        rgb = np.array(_limit_size(Image.fromarray(rgb), max_side))
+    if face_location is not None:
+        checked = _checked_face_location(face_location, rgb.shape[0] / original_height, rgb.shape)
+        if checked is None:
+            logger.warning(f"Ignoring implausible face location {face_location}")
+        face_location = checked
+    return IngestedImage(np.ascontiguousarray(rgb), face_location=face_location)
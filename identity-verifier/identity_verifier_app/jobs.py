@@ -0,0 +1,247 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+from django import db
+from django.conf import settings
+
+from .metrics import JOBS, JOBS_PENDING, count_verification
+from .utils import atomic_write, lazy
+
+logger = logging.getLogger("IdentityVerifier")
+
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{22}$")
+
+# Runs a verification, reporting stage progress. Returns: <HTTP status>, <response body>
+JobFunction = Callable[[Callable[[str, str], None]], Tuple[int, dict]]
+
+
+class Job:
+    """
+    A verification running in the background: its status ("queued", "running", "done" or "failed"), the state of
+    each of its stages and, once done, the response the synchronous API would have given.
+    """
+
+    FINAL_STATUSES = ("done", "failed")
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"
+        self.stages = {}
+        self.result = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # Incremented on every change, so that watchers can tell whether they have seen the latest state
+        self.version = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.FINAL_STATUSES
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": dict(self.stages),
+            "result": self.result,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "version": self.version,
+        }
+
+
+class JobQueue:
+    """
+    Runs verifications on a local thread pool, so that the request submitting one returns at once, and keeps their
+    state for `ttl` seconds after they finish so that clients can poll or stream it.
+
+    Jobs live in the memory of the process that accepted them. With `directory` set, their state is also written
+    there, so that any worker process sharing the directory can answer for them.
+    """
+
+    # How often a job owned by another process is checked for changes
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, workers: int, max_pending: int, ttl: float, directory: Optional[str] = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.directory = directory
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._jobs = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._executor = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, like the objects of utils.lazy
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verification-job")
+        return self._executor
+
+    def submit(self, run: JobFunction) -> Optional[Job]:
+        """
+        Queues a verification. Returns None if `max_pending` jobs are already queued or running.
+        """
+        self.prune()
+        with self._condition:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                JOBS.labels("rejected").inc()
+                return None
+            job = Job(secrets.token_urlsafe(16))
+            self._jobs[job.id] = job
+            self._pending += 1
+            self.submitted += 1
+            JOBS_PENDING.set(self._pending)
+            self._save(job)
+            self._get_executor().submit(self._run, job, run)
+        return job
+
+    def _run(self, job: Job, run: JobFunction):
+        # Job threads are long-lived and must not keep stale database connections
+        db.close_old_connections()
+        self._update(job, status="running")
+        try:
+            status_code, body = run(lambda stage, state: self._update(job, stage=(stage, state)))
+            self._update(job, status="done", result={"status_code": status_code, "body": body})
+        except Exception as e:
+            logger.error(f"Verification job {job.id} failed: {str(e)}")
+            count_verification("error")
+            self._update(job, status="failed", result={"status_code": 500, "body": {"error": "Server error"}})
+        finally:
+            db.close_old_connections()
+
+    def _update(self, job: Job, status: Optional[str] = None, stage=None, result=None):
+        with self._condition:
+            if job.finished:
+                # Stages cancelled too late finish in the background, after the outcome is known
+                return
+            if status is not None:
+                job.status = status
+            if stage is not None:
+                job.stages[stage[0]] = stage[1]
+            if result is not None:
+                job.result = result
+            job.updated_at = time.time()
+            job.version += 1
+            if job.finished:
+                self._pending -= 1
+                if job.status == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                JOBS.labels(job.status).inc()
+                JOBS_PENDING.set(self._pending)
+            self._save(job)
+            self._condition.notify_all()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job: Job):
+        if not self.directory:
+            return
+        try:
+            with atomic_write(self._path(job.id)) as f:
+                json.dump(job.to_dict(), f)
+        except OSError as e:
+            logger.warning(f"Cannot write verification job {job.id}: {str(e)}")
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        The current state of a job, or None if it is unknown or has expired.
+        """
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state["status"] in Job.FINAL_STATUSES and state["updated_at"] + self.ttl <= time.time():
+            return None
+        return state
+
+    def watch(self, job_id: str, timeout: float) -> Iterator[dict]:
+        """
+        Yields the state of a job every time it changes, starting with its current state, until it finishes or
+        `timeout` seconds have passed.
+        """
+        deadline = time.monotonic() + timeout
+        state = self.get(job_id)
+        if state is None:
+            return
+        yield state
+        while state["status"] not in Job.FINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with self._condition:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    self._condition.wait_for(lambda: job.version != state["version"], remaining)
+            if job is None:
+                time.sleep(min(self.POLL_INTERVAL, remaining))
+            latest = self.get(job_id)
+            if latest is None:
+                return
+            if latest["version"] != state["version"]:
+                state = latest
+                yield state
+
+    def prune(self):
+        """
+        Forgets jobs that finished more than `ttl` seconds ago. Their results hold personal data.
+        """
+        now = time.time()
+        with self._condition:
+            for job in list(self._jobs.values()):
+                if job.finished and job.updated_at + self.ttl <= now:
+                    del self._jobs[job.id]
+        if not self.directory:
+            return
+        for entry in os.scandir(self.directory):
+            try:
+                # Unfinished jobs are rewritten as they progress, so an old file is a finished or abandoned job
+                if entry.stat().st_mtime + self.ttl <= now:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending": self._pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+@lazy
+def get_job_queue() -> JobQueue:
+    return JobQueue(
+        settings.JOB_WORKERS,
+        settings.JOB_QUEUE_SIZE,
+        settings.JOB_RESULT_TTL_SECONDS,
+        settings.JOB_DIR,
+    )
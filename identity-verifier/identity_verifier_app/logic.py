@@ -0,0 +1,479 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import datetime
+import logging
+import re
+from typing import Callable, List, Optional, Tuple
+
+import face_recognition
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+
+from . import mrz, ocr
+from .cache import get_result_cache
+from .face_index import get_face_index
+from .ingestion import IngestedImage
+from .metrics import span
+from .models import Verification
+from .utils import lazy
+
+logger = logging.getLogger("IdentityVerifier")
+
+# Largest face encoding distance considered a match, face_recognition.compare_faces' default
+FACE_MATCH_TOLERANCE = 0.6
+# Closest past verifications of a face whose names are compared against a new one
+DUPLICATE_CANDIDATES = 20
+
+
+class IDExtraction:
+    def __init__(self):
+        self.first_name = "N/A"
+        self.last_name = "N/A"
+        self.gender = "N/A"
+        self.expiration_date = "N/A"
+        self.document_number = "N/A"
+
+
+def is_date_in_past(date_str):
+    # Convert the string to a datetime object
+    date_format = "%d.%m.%Y"  # Expected format: "DD.MM.YYYY"
+    input_date = datetime.strptime(date_str, date_format)
+    return input_date < datetime.now()
+
+
+def parse_id_document(
+    gray: np.ndarray, read_mrz: bool = True
+) -> Tuple[bool, Optional[bool], Optional[IDExtraction]]:
+    """
+    Parses the text of a grayscale image of an ID document.
+
+    A machine-readable zone whose check digits validate is trusted on its own (unless `read_mrz` is False, for
+    callers that have already tried). Otherwise, in the "layout" OCR mode
+    only the regions of the card holding the text we use are read. Full-page OCR is the fallback when the card
+    cannot be located or its regions do not yield the name and the expiry date.
+
+    Returns: <is_id_document>, <is_valid>, <extraction_data>
+    """
+    reader = apps.get_app_config("identity_verifier_app").get_reader()
+    if settings.MRZ_FAST_PATH and read_mrz:
+        with span("mrz"):
+            zone = mrz.read_mrz(reader, gray)
+        if zone is not None:
+            return parse_mrz(zone)
+        logger.info("No valid MRZ found, reading the document text")
+    if settings.OCR_MODE == "layout":
+        with span("locate_card"):
+            card = ocr.locate_card(gray)
+        if card is None:
+            logger.info("ID card not located, falling back to full-page OCR")
+        else:
+            with span("ocr_layout"):
+                result = parse_id_text(" ".join(ocr.read_card_regions(reader, card).values()))
+            is_id_document, _, data = result
+            if is_id_document and data.last_name != "N/A" and data.expiration_date != "N/A":
+                return result
+            logger.info("Card regions do not read as a complete ID document, falling back to full-page OCR")
+    with span("ocr_full"):
+        return parse_id_text(ocr.read_full_page(reader, gray))
+
+
+def parse_mrz(zone: mrz.MachineReadableZone) -> Tuple[bool, Optional[bool], Optional[IDExtraction]]:
+    """
+    Takes the extraction data from a validated machine-readable zone.
+
+    Returns: <is_id_document>, <is_valid>, <extraction_data>
+    """
+    extraction_data = IDExtraction()
+    extraction_data.last_name = zone.last_name
+    extraction_data.first_name = zone.first_name
+    extraction_data.gender = {"M": "MALE", "F": "FEMALE"}.get(zone.sex, "N/A")
+    extraction_data.expiration_date = zone.expiry_date.strftime("%d.%m.%Y")
+    extraction_data.document_number = zone.document_number
+    logger.info(
+        f"MRZ: {extraction_data.first_name} {extraction_data.last_name}, {extraction_data.gender}, "
+        f"document {extraction_data.document_number} expiring {extraction_data.expiration_date}"
+    )
+    return (True, not is_date_in_past(extraction_data.expiration_date), extraction_data)
+
+
+def parse_id_text(text: str) -> Tuple[bool, Optional[bool], Optional[IDExtraction]]:
+    """
+    Parses the OCR text of an ID document.
+
+    Returns: <is_id_document>, <is_valid>, <extraction_data>
+    """
+    text_lowered = text.lower()
+
+    keywords = [
+        "identity",
+        "identitate",
+        "carte",
+        "name",
+        "seria",
+        "nr",
+        "last name",
+        "first name",
+        "nationality",
+        "cetatenie",
+        "validity",
+        "sex",
+    ]
+    cnt_found = 0
+    for kw in keywords:
+        if kw in text_lowered:
+            cnt_found += 1
+            logger.info(f"Keyword found in document: {kw}")
+    ratio = cnt_found / len(keywords)
+    if ratio < 0.1:
+        return (False, None, None)
+
+    extraction_data = IDExtraction()
+    date = re.search(r"\d{2}\.\d{2}\.\d{2,4}-(\d{2}\.\d{2}\.\d{4})", text)
+    if date:
+        date = date.group(1)
+        logger.info(f"Document expiry date: {date}")
+        extraction_data.expiration_date = date
+
+    names = re.search(r"idrou(\w+)<+(\w+)<+", text, re.IGNORECASE)
+    if names:
+        last_name = names.group(1)
+        first_name = names.group(2)
+        logger.info(f"Name: {first_name.upper()} {last_name.upper()}")
+        extraction_data.last_name = last_name.upper()
+        extraction_data.first_name = first_name.upper()
+
+    gender = re.search(r"\s+([m|f])\s+", text, re.IGNORECASE)
+    if gender:
+        letter = gender.group(1)
+        if letter.lower() == "m":
+            gender = "MALE"
+        elif letter.lower() == "f":
+            gender = "FEMALE"
+        logger.info(f"Gender: {gender}")
+        extraction_data.gender = gender
+
+    if extraction_data.expiration_date != "N/A" and is_date_in_past(extraction_data.expiration_date):
+        return (True, False, extraction_data)
+    return (True, True, extraction_data)
+
+
+class VerificationOutcome:
+    def __init__(
+        self,
+        passed: bool,
+        message: Optional[str] = None,
+        extraction: Optional[IDExtraction] = None,
+        encoding: Optional[np.ndarray] = None,
+        duplicate_of: Optional[int] = None,
+    ):
+        self.passed = passed
+        self.message = message
+        self.extraction = extraction
+        # The portrait's face encoding, for passing verifications
+        self.encoding = encoding
+        # The ID of a past verification of the same face under another name
+        self.duplicate_of = duplicate_of
+
+
+@lazy
+def get_compute_pool() -> ThreadPoolExecutor:
+    """
+    Pool running the CPU-heavy verification stages, shared by all requests of the process.
+    """
+    return ThreadPoolExecutor(max_workers=settings.VERIFICATION_WORKERS, thread_name_prefix="verification")
+
+
+# A stage returns (<rejection message or None>, <result>)
+Stage = Tuple[str, Callable[[], Tuple[Optional[str], object]]]
+# Called with a stage name and its new state: "queued", "running", "passed", "rejected", "skipped" or "failed"
+Progress = Callable[[str, str], None]
+
+
+def _no_progress(stage: str, state: str):
+    pass
+
+
+def run_stages(stages: List[Stage], progress: Optional[Progress] = None) -> Tuple[Optional[str], dict]:
+    """
+    Runs independent stages concurrently on the compute pool, each timed as a span of the calling request.
+
+    Stages are listed by the priority of their rejection messages. As soon as the outcome is known, i.e. a stage
+    rejected and every stage before it passed, the stages still queued are cancelled. Stages already running
+    cannot be interrupted and finish in the background.
+
+    Returns: <rejection message or None>, <results by stage name>
+    """
+
+    progress = progress or _no_progress
+
+    def run_stage(name, run):
+        progress(name, "running")
+        try:
+            with span(name):
+                message, result = run()
+        except Exception:
+            progress(name, "failed")
+            raise
+        progress(name, "passed" if message is None else "rejected")
+        return message, result
+
+    pool = get_compute_pool()
+    for name, _ in stages:
+        progress(name, "queued")
+    # Each stage runs in a copy of the caller's context, so that its spans join the caller's trace
+    futures = [(name, pool.submit(contextvars.copy_context().run, run_stage, name, run)) for name, run in stages]
+    results = {}
+    try:
+        for name, future in futures:
+            message, results[name] = future.result()
+            if message is not None:
+                logger.info(f"Stage {name} rejected: {message}")
+                return message, results
+        return None, results
+    finally:
+        for name, future in futures:
+            if future.cancel():
+                progress(name, "skipped")
+
+
+def _extraction_to_dict(extraction: Optional[IDExtraction]) -> Optional[dict]:
+    return vars(extraction) if extraction is not None else None
+
+
+def _extraction_from_dict(value: Optional[dict]) -> Optional[IDExtraction]:
+    if value is None:
+        return None
+    extraction = IDExtraction()
+    extraction.__dict__.update(value)
+    return extraction
+
+
+def _document_namespace() -> str:
+    return f"document:{settings.OCR_MODE}:{int(settings.MRZ_FAST_PATH)}"
+
+
+def read_id_document(
+    id_doc: IngestedImage, parse: Optional[Callable[[], tuple]] = None
+) -> Tuple[bool, Optional[bool], Optional[IDExtraction]]:
+    """
+    parse_id_document, or `parse` if given, through the result cache. Only what was read from the document is
+    cached, whether it has expired is decided again every time.
+
+    Returns: <is_id_document>, <is_valid>, <extraction_data>
+    """
+    parse = parse or (lambda: parse_id_document(id_doc.gray))
+
+    def read():
+        is_id_document, _, data = parse()
+        return is_id_document, data
+
+    is_id_document, data = get_result_cache().get_or_compute(
+        _document_namespace(),
+        id_doc.digest,
+        read,
+        dump=lambda result: [result[0], _extraction_to_dict(result[1])],
+        load=lambda value: (value[0], _extraction_from_dict(value[1])),
+    )
+    if not is_id_document:
+        return (False, None, None)
+    is_valid = data.expiration_date == "N/A" or not is_date_in_past(data.expiration_date)
+    return (True, is_valid, data)
+
+
+def find_face_encodings(image: IngestedImage) -> List[np.ndarray]:
+    """
+    Encodes every face of an image. A face location known upstream is used as is, skipping face detection.
+    """
+    if image.face_location is not None:
+        locations = [image.face_location]
+    else:
+        locations = face_recognition.face_locations(
+            image.rgb, number_of_times_to_upsample=settings.FACE_DETECTION_UPSAMPLE
+        )
+    return face_recognition.face_encodings(
+        image.rgb, known_face_locations=locations, num_jitters=settings.FACE_ENCODING_JITTERS
+    )
+
+
+def face_encodings(image: IngestedImage) -> List[np.ndarray]:
+    """
+    find_face_encodings, through the result cache.
+    """
+    return get_result_cache().get_or_compute(
+        f"faces:{settings.FACE_DETECTION_UPSAMPLE}:{settings.FACE_ENCODING_JITTERS}",
+        image.digest,
+        lambda: find_face_encodings(image),
+        dump=lambda encodings: [encoding.tolist() for encoding in encodings],
+        load=lambda value: [np.array(encoding) for encoding in value],
+    )
+
+
+def check_id_document(
+    id_doc: IngestedImage, parse: Optional[Callable[[], tuple]] = None
+) -> Tuple[Optional[str], Optional[IDExtraction]]:
+    is_id_document, is_valid, data = read_id_document(id_doc, parse)
+    if not is_id_document:
+        return "The uploaded file is not an ID document", None
+    if not is_valid and data.expiration_date != "N/A":
+        return "Expired ID document", None
+    if not is_valid:
+        return "Invalid ID document", None
+    return None, data
+
+
+def encode_document_face(id_doc: IngestedImage) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    doc_faces = face_encodings(id_doc)
+    if len(doc_faces) == 0:
+        return "Try uploading a clearer photo of your ID document", None
+    return None, doc_faces[0]
+
+
+def encode_portrait_face(portrait: IngestedImage) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    portrait_faces = face_encodings(portrait)
+    # Validate portrait
+    if len(portrait_faces) == 0:
+        return "Try taking another portrait in better light", None
+    if len(portrait_faces) > 1:
+        return "There is more than one person in the portrait", None
+    return None, portrait_faces[0]
+
+
+def find_duplicate_identity(encoding: np.ndarray, extraction: IDExtraction) -> Optional[int]:
+    """
+    Searches the face index for a past passing verification of the same face under another name.
+
+    Returns its ID, or None. The search is skipped, with a warning, when the index cannot be read or updated.
+    """
+    try:
+        with span("duplicate_search"):
+            matches = get_face_index().search(encoding, settings.DUPLICATE_FACE_TOLERANCE)[:DUPLICATE_CANDIDATES]
+        if not matches:
+            return None
+        names = {
+            verification_id: (first_name, last_name)
+            for verification_id, first_name, last_name in Verification.objects.filter(
+                id__in=[verification_id for verification_id, _ in matches]
+            ).values_list("id", "first_name", "last_name")
+        }
+    except Exception as e:
+        logger.warning(f"Cannot search the face index: {str(e)}")
+        return None
+    for verification_id, distance in matches:
+        if verification_id in names and names[verification_id] != (extraction.first_name, extraction.last_name):
+            logger.warning(
+                f"Face already verified under another name, in verification {verification_id} (distance {distance:.3f})"
+            )
+            return verification_id
+    return None
+
+
+def check_duplicate_identity(encoding: np.ndarray, extraction: IDExtraction) -> VerificationOutcome:
+    """
+    The outcome of a verification whose faces match, depending on DUPLICATE_IDENTITY_ACTION.
+    """
+    duplicate_of = find_duplicate_identity(encoding, extraction)
+    if duplicate_of is not None and settings.DUPLICATE_IDENTITY_ACTION == "reject":
+        return VerificationOutcome(
+            False, "This face was already verified under another identity", duplicate_of=duplicate_of
+        )
+    return VerificationOutcome(True, extraction=extraction, encoding=encoding, duplicate_of=duplicate_of)
+
+
+def verify_identity(
+    id_doc: IngestedImage, portrait: IngestedImage, progress: Optional[Progress] = None
+) -> VerificationOutcome:
+    """
+    Runs the document OCR and both face encodings concurrently, then compares the faces and looks for the portrait
+    among past verifications. `progress` is told about every stage as it starts and ends, the comparison being the
+    last stage, "compare".
+    """
+    progress = progress or _no_progress
+    message, results = run_stages(
+        [
+            ("document", lambda: check_id_document(id_doc)),
+            ("document_face", lambda: encode_document_face(id_doc)),
+            ("portrait_face", lambda: encode_portrait_face(portrait)),
+        ],
+        progress,
+    )
+    if message is not None:
+        progress("compare", "skipped")
+        return VerificationOutcome(False, message)
+
+    progress("compare", "running")
+    faces = [results["portrait_face"]]
+    with span("compare"):
+        match = face_recognition.compare_faces(faces, results["document_face"], tolerance=FACE_MATCH_TOLERANCE)[0]
+    if not match:
+        progress("compare", "rejected")
+        return VerificationOutcome(False, "Faces do not match")
+    outcome = check_duplicate_identity(results["portrait_face"], results["document"])
+    progress("compare", "passed" if outcome.passed else "rejected")
+    return outcome
+
+
+def verify_identity_batch(
+    pairs: List[Tuple[IngestedImage, IngestedImage]]
+) -> List[Optional[VerificationOutcome]]:
+    """
+    Verifies many (id_doc, portrait) pairs at once, for back-office use. The MRZs of all documents whose result
+    is not cached are read in one batched OCR call, the remaining stages of every pair share the compute pool, and
+    all faces are compared in one vectorized step. Rejections are reported with the same priority as
+    verify_identity.
+
+    Returns the outcome of each pair, None for pairs whose verification failed with an error.
+    """
+    pool = get_compute_pool()
+    # Documents read before are taken from the result cache by check_id_document, without reading their MRZ
+    uncached = []
+    if settings.MRZ_FAST_PATH:
+        cache = get_result_cache()
+        namespace = _document_namespace()
+        uncached = [i for i, (id_doc, _) in enumerate(pairs) if not cache.contains(namespace, id_doc.digest)]
+    zones = {}
+    if uncached:
+        reader = apps.get_app_config("identity_verifier_app").get_reader()
+        with span("mrz_batch"):
+            zones = dict(zip(uncached, mrz.read_mrz_batch(reader, [pairs[i][0].gray for i in uncached])))
+
+    def document_parser(i, id_doc):
+        if i not in zones:
+            # Parsed as usual, should the cached result have expired since
+            return None
+        if zones[i] is not None:
+            return lambda: parse_mrz(zones[i])
+        return lambda: parse_id_document(id_doc.gray, read_mrz=False)
+
+    stages = [
+        (
+            pool.submit(check_id_document, id_doc, document_parser(i, id_doc)),
+            pool.submit(encode_document_face, id_doc),
+            pool.submit(encode_portrait_face, portrait),
+        )
+        for i, (id_doc, portrait) in enumerate(pairs)
+    ]
+
+    outcomes = [None] * len(pairs)
+    compared = []
+    for i, futures in enumerate(stages):
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            logger.error(f"Verification {i} of the batch failed: {str(e)}")
+            continue
+        message = next((message for message, _ in results if message is not None), None)
+        if message is not None:
+            outcomes[i] = VerificationOutcome(False, message)
+        else:
+            compared.append((i, results))
+    if compared:
+        document_faces = np.array([results[1][1] for _, results in compared])
+        portrait_faces = np.array([results[2][1] for _, results in compared])
+        matches = np.linalg.norm(document_faces - portrait_faces, axis=1) <= FACE_MATCH_TOLERANCE
+        for (i, results), match in zip(compared, matches):
+            if match:
+                outcomes[i] = check_duplicate_identity(results[2][1], results[0][1])
+            else:
+                outcomes[i] = VerificationOutcome(False, "Faces do not match")
+    return outcomes
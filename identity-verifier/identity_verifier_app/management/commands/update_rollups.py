@@ -0,0 +1,34 @@
+import time
+
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+
+from identity_verifier_app.analytics import update_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Updates the analytics rollups with the verifications stored since the last update. With --every, keeps "
+        "updating them at that interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--every", type=float, help="Seconds between updates, to run as a scheduler")
+
+    def handle(self, *args, **options):
+        every = options["every"]
+        if every is not None and every <= 0:
+            raise CommandError("--every must be positive")
+        while True:
+            started = time.monotonic()
+            try:
+                count = update_rollups()
+                self.stderr.write(f"Rolled up {count} recent verifications in {time.monotonic() - started:.2f} s")
+            except db.Error as e:
+                if every is None:
+                    raise CommandError(f"Cannot update the rollups: {str(e)}")
+                self.stderr.write(f"Cannot update the rollups, retrying: {str(e)}")
+                db.close_old_connections()
+            if every is None:
+                return
+            time.sleep(max(every - (time.monotonic() - started), 0))
@@ -0,0 +1,123 @@
+import csv
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from identity_verifier_app.cache import get_result_cache
+from identity_verifier_app.ingestion import InvalidImage, ingest_upload
+from identity_verifier_app.logic import get_compute_pool, verify_identity, verify_identity_batch
+from identity_verifier_app.views import build_negative_response, build_positive_response
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifies many (ID document, portrait) pairs, listed in a CSV file with `id_document` and `portrait` "
+        "columns holding image paths relative to the file. Writes one JSON line per pair, batch by batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pairs", help="CSV file listing the pairs")
+        parser.add_argument("--batch-size", type=int, default=16, help="Pairs verified together (default: 16)")
+        parser.add_argument("--output", help="File to write the results to instead of the standard output")
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="Afterwards verify the pairs again one at a time, as the API does, and report both rates",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if options["compare"] and get_result_cache().enabled:
+            raise CommandError(
+                "--compare needs the result cache disabled (VERIFICATION_CACHE_TTL_SECONDS=0), or the second run "
+                "would read the results of the first"
+            )
+        try:
+            with open(options["pairs"], newline="") as f:
+                rows = list(csv.DictReader(f))
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['pairs']}: {str(e)}")
+        if rows and not {"id_document", "portrait"} <= rows[0].keys():
+            raise CommandError("The CSV file needs `id_document` and `portrait` columns")
+
+        base_dir = os.path.dirname(os.path.abspath(options["pairs"]))
+        output = open(options["output"], "w") if options["output"] else None
+        try:
+            started = time.monotonic()
+            for start in range(0, len(rows), options["batch_size"]):
+                batch = list(enumerate(rows[start : start + options["batch_size"]], start))
+                for line in self._verify(batch, base_dir):
+                    if output is not None:
+                        output.write(line + "\n")
+                        output.flush()
+                    else:
+                        self.stdout.write(line)
+            elapsed = time.monotonic() - started
+        finally:
+            if output is not None:
+                output.close()
+
+        rate = len(rows) / elapsed if elapsed > 0 else 0.0
+        self.stderr.write(f"Verified {len(rows)} pairs in {elapsed:.1f} s ({rate:.2f} pairs/s)")
+        if options["compare"]:
+            started = time.monotonic()
+            for index, row in enumerate(rows):
+                self._verify_one(index, row, base_dir)
+            single_elapsed = time.monotonic() - started
+            single_rate = len(rows) / single_elapsed if single_elapsed > 0 else 0.0
+            self.stderr.write(
+                f"Verified them one at a time in {single_elapsed:.1f} s ({single_rate:.2f} pairs/s), "
+                f"batching is {rate / single_rate if single_rate > 0 else 0.0:.2f}x as fast"
+            )
+
+    @staticmethod
+    def _ingest(row, base_dir):
+        try:
+            with open(os.path.join(base_dir, row["id_document"]), "rb") as id_doc_file:
+                id_doc = ingest_upload(id_doc_file)
+            with open(os.path.join(base_dir, row["portrait"]), "rb") as portrait_file:
+                portrait = ingest_upload(portrait_file)
+            return (id_doc, portrait), None
+        except (OSError, InvalidImage) as e:
+            return None, str(e)
+
+    def _verify_one(self, index, row, base_dir):
+        """
+        Verifies a pair the way the verification API does, for --compare. The outcome is discarded.
+        """
+        pair, _ = self._ingest(row, base_dir)
+        if pair is None:
+            return
+        try:
+            verify_identity(*pair)
+        except Exception as e:
+            self.stderr.write(f"Verification {index} failed: {str(e)}")
+
+    def _verify(self, batch, base_dir):
+        """
+        Verifies one batch of (index, row) items. Returns a JSON line per item, in the order of the CSV file.
+        """
+        ingested = list(get_compute_pool().map(lambda row: self._ingest(row, base_dir), [row for _, row in batch]))
+        valid = [pair for pair, _ in ingested if pair is not None]
+        outcomes = iter(verify_identity_batch(valid))
+
+        lines = []
+        for (index, row), (pair, error) in zip(batch, ingested):
+            item = {"index": index, "id_document": row["id_document"], "portrait": row["portrait"]}
+            if pair is None:
+                item["error"] = f"Invalid image: {error}"
+            else:
+                outcome = next(outcomes)
+                if outcome is None:
+                    item["error"] = "Server error"
+                elif outcome.passed:
+                    item.update(
+                        build_positive_response(outcome.extraction, outcome.encoding, outcome.duplicate_of).data
+                    )
+                else:
+                    item.update(build_negative_response(outcome.message, outcome.duplicate_of).data)
+            lines.append(json.dumps(item))
+        return lines
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+import random
+import time
+
+from django.conf import settings
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+
+logger = logging.getLogger("IdentityVerifier")
+
+# OCR and face encoding on a CPU take seconds, so the default buckets are extended
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_SECONDS = Histogram(
+    "identity_verifier_request_seconds", "Latency of verification requests", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "identity_verifier_stage_seconds", "Latency of each verification stage", ["stage"], buckets=LATENCY_BUCKETS
+)
+VERIFICATIONS = Counter(
+    "identity_verifier_verifications", "Verifications by outcome and rejection message", ["outcome", "message"]
+)
+CACHE_LOOKUPS = Counter("identity_verifier_cache_lookups", "Result cache lookups", ["result"])
+JOBS = Counter("identity_verifier_jobs", "Verification jobs by final status, or rejected when queued", ["status"])
+JOBS_PENDING = Gauge(
+    "identity_verifier_jobs_pending", "Verification jobs queued or running", multiprocess_mode="livesum"
+)
+AUDIT_RECORDS = Counter(
+    "identity_verifier_audit_records", "Verification records by where they were written", ["destination"]
+)
+AUDIT_QUEUE_DEPTH = Gauge(
+    "identity_verifier_audit_queue_depth", "Verification records waiting to be written", multiprocess_mode="livesum"
+)
+AUDIT_FLUSH_SECONDS = Histogram(
+    "identity_verifier_audit_flush_seconds", "Latency of writing a batch of verification records"
+)
+FACE_INDEX_ROWS = Gauge(
+    "identity_verifier_face_index_rows", "Face encodings in the face index", multiprocess_mode="livemax"
+)
+
+_trace = ContextVar("trace", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Times a verification stage into STAGE_SECONDS, and into the trace of the request if it is being traced.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        trace = _trace.get()
+        if trace is not None:
+            trace["spans"].append((stage, round((started - trace["started"]) * 1000, 1), round(elapsed * 1000, 1)))
+
+
+@contextmanager
+def trace(endpoint: str):
+    """
+    Times a verification request into REQUEST_SECONDS. A TRACE_SAMPLE_RATE share of requests also log every span
+    they ran, as (<stage>, <start offset ms>, <duration ms>).
+
+    Stages run on other threads are only traced if they run in a copy of the request's context (see run_stages).
+    """
+    started = time.perf_counter()
+    sampled = settings.TRACE_SAMPLE_RATE > 0 and random.random() < settings.TRACE_SAMPLE_RATE
+    token = _trace.set({"started": started, "spans": []}) if sampled else None
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        if token is not None:
+            spans = _trace.get()["spans"]
+            _trace.reset(token)
+            logger.info(f"Trace {endpoint} {elapsed * 1000:.1f} ms: {json.dumps(sorted(spans, key=lambda s: s[1]))}")
+
+
+def count_verification(outcome: str, message: str = ""):
+    """
+    Counts a verification: "passed", "rejected" with its message, or "error".
+    """
+    VERIFICATIONS.labels(outcome, message or "").inc()
+
+
+def exposition() -> bytes:
+    """
+    All metrics in the Prometheus text format, summed over the Gunicorn workers when PROMETHEUS_MULTIPROC_DIR is
+    set (see gunicorn.conf.py).
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
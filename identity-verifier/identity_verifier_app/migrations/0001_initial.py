@@ -0,0 +1,27 @@
+# Generated by Django 4.2.16 on 2026-10-17 04:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Verification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('passed', models.BooleanField()),
+                ('message', models.CharField(max_length=200, null=True)),
+                ('first_name', models.CharField(max_length=50, null=True)),
+                ('last_name', models.CharField(max_length=50, null=True)),
+                ('gender', models.CharField(max_length=10, null=True)),
+                ('document_expiration_date', models.DateField(null=True)),
+            ],
+        ),
+    ]
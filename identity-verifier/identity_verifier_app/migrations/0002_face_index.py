@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-17 04:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity_verifier_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verification',
+            name='duplicate_of',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='identity_verifier_app.verification'),
+        ),
+        migrations.AddField(
+            model_name='verification',
+            name='face_encoding',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.16 on 2026-10-17 04:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity_verifier_app', '0002_face_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('expiry_month', models.DateField()),
+                ('count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HourlyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('passed', models.BooleanField()),
+                ('message', models.CharField(max_length=200)),
+                ('count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_verification_id', models.BigIntegerField(default=0)),
+                ('seen_verification_id', models.BigIntegerField(default=0)),
+                ('seen_at', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='verification',
+            index=models.Index(fields=['timestamp'], name='identity_ve_timesta_2994a6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='verification',
+            index=models.Index(fields=['passed', 'timestamp'], name='identity_ve_passed_1fa158_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='verification',
+            index=models.Index(fields=['message', 'timestamp'], name='identity_ve_message_6965e5_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hourlyrollup',
+            constraint=models.UniqueConstraint(fields=('hour', 'passed', 'message'), name='unique_hourly_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='expiryrollup',
+            constraint=models.UniqueConstraint(fields=('hour', 'expiry_month'), name='unique_expiry_rollup'),
+        ),
+    ]
@@ -9,3 +9,53 @@ class Verification(models.Model):
     last_name = models.CharField(max_length=50, null=True)
     gender = models.CharField(max_length=10, null=True)
     document_expiration_date = models.DateField(null=True)
+    # The 128-d portrait face encoding of a passing verification, as float32 bytes, searched by the face index
+    face_encoding = models.BinaryField(null=True)
+    # A past verification of the same face under another name
+    duplicate_of = models.ForeignKey("self", null=True, on_delete=models.SET_NULL, related_name="+")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["timestamp"]),
+            models.Index(fields=["passed", "timestamp"]),
+            models.Index(fields=["message", "timestamp"]),
+        ]
+
+
+class HourlyRollup(models.Model):
+    """
+    Number of verifications per hour, outcome and rejection message ("" for passing verifications).
+    """
+
+    hour = models.DateTimeField()
+    passed = models.BooleanField()
+    message = models.CharField(max_length=200)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["hour", "passed", "message"], name="unique_hourly_rollup")]
+
+
+class ExpiryRollup(models.Model):
+    """
+    Number of passing verifications per hour and month in which the verified document expires.
+    """
+
+    hour = models.DateTimeField()
+    expiry_month = models.DateField()
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["hour", "expiry_month"], name="unique_expiry_rollup")]
+
+
+class RollupState(models.Model):
+    """
+    How far the rollups have been updated: the single row holds the last verification that every later update may
+    skip, and the highest verification ID seen by an update and when, which takes its place once settled.
+    """
+
+    last_verification_id = models.BigIntegerField(default=0)
+    seen_verification_id = models.BigIntegerField(default=0)
+    seen_at = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(null=True)
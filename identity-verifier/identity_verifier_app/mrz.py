@@ -0,0 +1,209 @@
+from datetime import date
+import logging
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from .ocr import order_corners
+
+logger = logging.getLogger("IdentityVerifier")
+
+MRZ_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<"
+# Identity cards with a two-line MRZ (ICAO 9303 TD2), e.g. Romanian identity cards
+TD2_LINE_LENGTH = 36
+# Size MRZ bands are brought to for batched OCR
+BATCH_BAND_SIZE = (960, 120)
+
+# OCR confusions fixed in fields that can only hold digits or only letters
+_TO_DIGIT = str.maketrans("OQDILZSBGT", "0001125867")
+_TO_LETTER = str.maketrans("0125867", "OIZSBGT")
+
+
+class MachineReadableZone:
+    def __init__(self):
+        self.document_code = None
+        self.issuing_state = None
+        self.last_name = None
+        self.first_name = None
+        self.document_number = None
+        self.nationality = None
+        self.birth_date = None
+        self.sex = None
+        self.expiry_date = None
+
+
+def check_digit(value: str) -> int:
+    """
+    ICAO 9303 check digit: characters weighted 7, 3, 1, with digits worth themselves, A-Z 10-35 and filler 0.
+    """
+    total = 0
+    for i, char in enumerate(value):
+        if char.isdigit():
+            number = int(char)
+        elif "A" <= char <= "Z":
+            number = ord(char) - ord("A") + 10
+        else:
+            number = 0
+        total += number * (7, 3, 1)[i % 3]
+    return total % 10
+
+
+def _parse_date(yymmdd: str, future: bool) -> Optional[date]:
+    """
+    Parses a YYMMDD MRZ date. Expiry dates (`future`) are placed in this century, birth dates in the past.
+    """
+    try:
+        year, month, day = int(yymmdd[:2]), int(yymmdd[2:4]), int(yymmdd[4:])
+        today = date.today()
+        century = 2000 if future or 2000 + year <= today.year else 1900
+        return date(century + year, month, day)
+    except ValueError:
+        return None
+
+
+def parse_td2(line1: str, line2: str) -> Optional[MachineReadableZone]:
+    """
+    Parses a two-line, 36 character MRZ. Returns None unless it is an identity document MRZ whose check digits
+    all validate.
+    """
+    if len(line1) != TD2_LINE_LENGTH or len(line2) != TD2_LINE_LENGTH or line1[0] not in "IAC":
+        return None
+    # Digit-only positions: check digits, dates and the composite check digit
+    line2 = "".join(
+        char.translate(_TO_DIGIT) if i in (9, 19, 27, 35) or 13 <= i < 19 or 21 <= i < 27 else char
+        for i, char in enumerate(line2)
+    )
+    if not all(char.isdigit() for char in line2[13:20] + line2[21:28] + line2[9] + line2[35]):
+        return None
+
+    checks = [
+        (line2[0:9], line2[9]),
+        (line2[13:19], line2[19]),
+        (line2[21:27], line2[27]),
+        (line2[0:10] + line2[13:20] + line2[21:35], line2[35]),
+    ]
+    if any(check_digit(value) != int(digit) for value, digit in checks):
+        return None
+
+    zone = MachineReadableZone()
+    zone.document_code = line1[0:2].rstrip("<")
+    zone.issuing_state = line1[2:5].translate(_TO_LETTER)
+    surname, _, given_names = line1[5:].translate(_TO_LETTER).partition("<<")
+    zone.last_name = surname.replace("<", " ").strip()
+    zone.first_name = given_names.replace("<", " ").strip()
+    zone.document_number = line2[0:9].rstrip("<")
+    zone.nationality = line2[10:13].translate(_TO_LETTER)
+    zone.birth_date = _parse_date(line2[13:19], future=False)
+    zone.sex = line2[20]
+    zone.expiry_date = _parse_date(line2[21:27], future=True)
+    if not zone.last_name or zone.expiry_date is None:
+        return None
+    return zone
+
+
+def find_mrz_band(gray: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Finds the two long, adjacent text lines at the bottom of a document that form its MRZ, and returns them cropped
+    from `gray` and deskewed, or None.
+    """
+    height, width = gray.shape
+    scale = min(1.0, 800 / width)
+    small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (3, 3), 0)
+
+    # Dark characters on a light background, joined horizontally into text lines
+    blackhat = cv2.morphologyEx(small, cv2.MORPH_BLACKHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (13, 5)))
+    gradient = np.absolute(cv2.Sobel(blackhat, cv2.CV_32F, 1, 0, ksize=-1))
+    gradient = cv2.normalize(gradient, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    gradient = cv2.morphologyEx(gradient, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1)))
+    _, thresh = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, 3)))
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    lines = []
+    for contour in contours:
+        (cx, cy), (w, h), _ = cv2.minAreaRect(contour)
+        length, thickness = max(w, h), min(w, h)
+        if length > 0.35 * small.shape[1] and length > 10 * thickness:
+            lines.append((cy, length, thickness, contour))
+    lines.sort(key=lambda line: line[0], reverse=True)
+
+    for lower, upper in zip(lines, lines[1:]):
+        similar = min(lower[1], upper[1]) > 0.8 * max(lower[1], upper[1])
+        if similar and lower[0] - upper[0] < 4 * max(lower[2], upper[2]):
+            break
+    else:
+        return None
+
+    (cx, cy), (w, h), angle = cv2.minAreaRect(np.vstack([lower[3], upper[3]]))
+    # Some margin, since the characters' ascenders and the filler ends are trimmed. Depending on its angle,
+    # minAreaRect reports the length of a horizontal band as either side.
+    size = (w * 1.06, h * 1.3) if w >= h else (w * 1.3, h * 1.06)
+    band = ((cx / scale, cy / scale), (size[0] / scale, size[1] / scale), angle)
+    corners = order_corners(cv2.boxPoints(band))
+    top_left, top_right, _, bottom_left = corners
+    band_width = int(np.linalg.norm(top_right - top_left))
+    band_height = int(np.linalg.norm(bottom_left - top_left))
+    if band_width < band_height:
+        return None
+    target = np.array(
+        [[0, 0], [band_width - 1, 0], [band_width - 1, band_height - 1], [0, band_height - 1]], dtype=np.float32
+    )
+    transform = cv2.getPerspectiveTransform(corners, target)
+    return cv2.warpPerspective(gray, transform, (band_width, band_height), borderMode=cv2.BORDER_REPLICATE)
+
+
+def _group_lines(results) -> List[str]:
+    """
+    Joins OCR results into text lines, top to bottom, by the vertical centres of their boxes.
+    """
+    boxes = []
+    for box, text, _ in results:
+        ys = [point[1] for point in box]
+        boxes.append(((min(ys) + max(ys)) / 2, max(ys) - min(ys), min(point[0] for point in box), text))
+    lines = []
+    for centre, box_height, left, text in sorted(boxes):
+        if lines and centre - lines[-1][0] < box_height / 2:
+            lines[-1][1].append((left, text))
+        else:
+            lines.append((centre, [(left, text)]))
+    return ["".join(text for _, text in sorted(parts)).replace(" ", "").upper() for _, parts in lines]
+
+
+def _parse_results(results) -> Optional[MachineReadableZone]:
+    lines = [line for line in _group_lines(results) if len(line) >= TD2_LINE_LENGTH - 6]
+    for line1, line2 in zip(lines, lines[1:]):
+        # Trailing fillers of the name line are often dropped or read short
+        line1 = line1[:TD2_LINE_LENGTH].ljust(TD2_LINE_LENGTH, "<")
+        zone = parse_td2(line1, line2)
+        if zone is not None:
+            return zone
+    logger.info(f"MRZ not read: {lines}")
+    return None
+
+
+def read_mrz(reader, gray: np.ndarray) -> Optional[MachineReadableZone]:
+    """
+    Locates and reads a TD2 MRZ in an image of a document. Returns None if there is none or it does not validate.
+    """
+    band = find_mrz_band(gray)
+    if band is None:
+        return None
+    return _parse_results(reader.readtext(band, allowlist=MRZ_ALPHABET))
+
+
+def read_mrz_batch(reader, grays: List[np.ndarray]) -> List[Optional[MachineReadableZone]]:
+    """
+    read_mrz for many documents, recognizing all their MRZ bands in one batched OCR call.
+    """
+    bands = [find_mrz_band(gray) for gray in grays]
+    found = [i for i, band in enumerate(bands) if band is not None]
+    zones = [None] * len(grays)
+    if not found:
+        return zones
+    # Batched detection needs images of one size; MRZ bands all have about the same proportions
+    resized = [cv2.resize(bands[i], BATCH_BAND_SIZE, interpolation=cv2.INTER_AREA) for i in found]
+    for i, results in zip(found, reader.readtext_batched(resized, allowlist=MRZ_ALPHABET)):
+        zones[i] = _parse_results(results)
+    return zones
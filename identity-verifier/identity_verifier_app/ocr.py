@@ -0,0 +1,91 @@
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+# Size the located card is warped to; an ID-1 card is 85.60 x 53.98 mm
+CARD_WIDTH, CARD_HEIGHT = 1000, 630
+CARD_ASPECT_RATIO = 85.60 / 53.98
+
+# Regions of a Romanian identity card holding the text the parser uses, as (x0, y0, x1, y1) fractions of the card
+CARD_REGIONS = {
+    # "CARTE DE IDENTITATE / IDENTITY CARD", "SERIA .. NR ......"
+    "header": (0.0, 0.0, 1.0, 0.22),
+    # "Sex/Sexe/Sex M"
+    "sex": (0.78, 0.32, 1.0, 0.52),
+    # "Valabilitate/Validite/Validity dd.mm.yy-dd.mm.yyyy"
+    "validity": (0.6, 0.6, 1.0, 0.78),
+    # Machine-readable zone, two lines at the bottom of the card
+    "mrz": (0.0, 0.76, 1.0, 1.0),
+}
+
+
+def order_corners(points: np.ndarray) -> np.ndarray:
+    """
+    Orders four points as top-left, top-right, bottom-right, bottom-left.
+    """
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array(
+        [points[np.argmin(sums)], points[np.argmin(diffs)], points[np.argmax(sums)], points[np.argmax(diffs)]],
+        dtype=np.float32,
+    )
+
+
+def locate_card(gray: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Finds the ID card in a photo and returns it warped to CARD_WIDTH x CARD_HEIGHT, or None if no card outline
+    is found. An image that has the proportions of a card and no visible outline is taken to be a cropped card.
+    """
+    height, width = gray.shape
+    # Contours are searched on a small copy, only the corners are needed
+    scale = min(1.0, 800 / max(height, width))
+    small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_area = 0.2 * small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) != 4:
+            continue
+        corners = order_corners(approx.reshape(4, 2).astype(np.float32) / scale)
+        top_left, top_right, bottom_right, bottom_left = corners
+        if np.linalg.norm(top_right - top_left) < np.linalg.norm(bottom_left - top_left):
+            # Card photographed upright: rotate so that its long side is horizontal
+            corners = np.roll(corners, -1, axis=0)
+        target = np.array(
+            [[0, 0], [CARD_WIDTH - 1, 0], [CARD_WIDTH - 1, CARD_HEIGHT - 1], [0, CARD_HEIGHT - 1]], dtype=np.float32
+        )
+        transform = cv2.getPerspectiveTransform(corners, target)
+        return cv2.warpPerspective(gray, transform, (CARD_WIDTH, CARD_HEIGHT))
+
+    if abs(max(width, height) / min(width, height) - CARD_ASPECT_RATIO) < 0.15 * CARD_ASPECT_RATIO:
+        card = gray if width >= height else cv2.rotate(gray, cv2.ROTATE_90_CLOCKWISE)
+        return cv2.resize(card, (CARD_WIDTH, CARD_HEIGHT), interpolation=cv2.INTER_AREA)
+    return None
+
+
+def crop_region(card: np.ndarray, region: str) -> np.ndarray:
+    x0, y0, x1, y1 = CARD_REGIONS[region]
+    return card[int(y0 * CARD_HEIGHT) : int(y1 * CARD_HEIGHT), int(x0 * CARD_WIDTH) : int(x1 * CARD_WIDTH)]
+
+
+def _readtext(reader, img: np.ndarray, **kwargs) -> str:
+    blurred = cv2.GaussianBlur(img, (3, 3), 0)
+    results = reader.readtext(blurred, **kwargs)
+    return " ".join([result[1] for result in results])
+
+
+def read_card_regions(reader, card: np.ndarray) -> Dict[str, str]:
+    """
+    Runs OCR only on the regions of a located card that the parser needs.
+    """
+    return {region: _readtext(reader, crop_region(card, region)) for region in CARD_REGIONS}
+
+
+def read_full_page(reader, gray: np.ndarray) -> str:
+    return _readtext(reader, gray)
@@ -1,3 +1,448 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone
+from io import BytesIO
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django import db
+from django.core import serializers
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from PIL import Image
+
+from . import analytics, face_index
+from .analytics import report, update_rollups
+from .audit import AuditLog
+from .cache import ResultCache
+from .ingestion import InvalidImage, ingest_upload
+from .jobs import JobQueue
+from .models import Verification
+from .mrz import check_digit, find_mrz_band, parse_td2
+
+# The TD2 specimen of ICAO 9303 part 6
+SPECIMEN = ("I<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<", "D231458907UTO7408122F1204159<<<<<<<6")
+
+
+def render_card(lines, angle=0):
+    """
+    A light grey card with a title and `lines` as its MRZ, rotated by `angle` degrees. Returns the image and the
+    (left, top, right, bottom) box of the MRZ text before rotation, None without lines.
+    """
+    card = np.full((630, 1000), 235, np.uint8)
+    cv2.putText(card, "IDENTITY CARD", (60, 80), cv2.FONT_HERSHEY_SIMPLEX, 1.4, 40, 3)
+    for i, line in enumerate(lines):
+        cv2.putText(card, line, (40, 530 + i * 45), cv2.FONT_HERSHEY_PLAIN, 2.0, 20, 2)
+    box = None
+    if lines:
+        ys, xs = np.nonzero(card[450:] < 128)
+        box = (xs.min(), ys.min() + 450, xs.max(), ys.max() + 450)
+    rotation = cv2.getRotationMatrix2D((500, 315), angle, 1.0)
+    return cv2.warpAffine(card, rotation, (1000, 630), borderValue=235), box
+
+
+class CheckDigitTests(SimpleTestCase):
+    def test_specimen_fields(self):
+        self.assertEqual(check_digit("D23145890"), 7)
+        self.assertEqual(check_digit("740812"), 2)
+        self.assertEqual(check_digit("120415"), 9)
+
+    def test_filler_counts_as_zero(self):
+        self.assertEqual(check_digit("AB<<"), check_digit("AB00"))
+
+
+class ParseTD2Tests(SimpleTestCase):
+    def test_specimen(self):
+        zone = parse_td2(*SPECIMEN)
+        self.assertEqual(zone.document_code, "I")
+        self.assertEqual(zone.issuing_state, "UTO")
+        self.assertEqual(zone.last_name, "ERIKSSON")
+        self.assertEqual(zone.first_name, "ANNA MARIA")
+        self.assertEqual(zone.document_number, "D23145890")
+        self.assertEqual(zone.nationality, "UTO")
+        self.assertEqual(zone.birth_date, date(1974, 8, 12))
+        self.assertEqual(zone.sex, "F")
+        self.assertEqual(zone.expiry_date, date(2012, 4, 15))
+
+    def test_fixes_ocr_confusions_in_digit_fields(self):
+        line2 = SPECIMEN[1].replace("7408122", "74O8I22")
+        self.assertEqual(parse_td2(SPECIMEN[0], line2).birth_date, date(1974, 8, 12))
+
+    def test_rejects_wrong_check_digit(self):
+        self.assertIsNone(parse_td2(SPECIMEN[0], SPECIMEN[1].replace("7408122", "7408132")))
+
+    def test_rejects_wrong_length(self):
+        self.assertIsNone(parse_td2(SPECIMEN[0][:-1], SPECIMEN[1]))
+
+    def test_rejects_non_identity_document(self):
+        self.assertIsNone(parse_td2("P" + SPECIMEN[0][1:], SPECIMEN[1]))
+
+
+class FindMRZBandTests(SimpleTestCase):
+    def assert_band_holds_text(self, band, box):
+        left, top, right, bottom = box
+        text_length, text_thickness = right - left + 1, bottom - top + 1
+        band_thickness, band_length = band.shape
+        # Margin on all sides, but hardly beyond the text's ends
+        self.assertGreater(band_thickness, text_thickness * 1.1)
+        self.assertGreaterEqual(band_length, text_length)
+        self.assertLess(band_length, text_length * 1.15)
+        # No glyph is cut at the band's edges
+        for edge in (band[0], band[-1], band[:, 0], band[:, -1]):
+            self.assertGreater(edge.min(), 128)
+
+    def test_horizontal_band(self):
+        card, box = render_card(SPECIMEN)
+        self.assert_band_holds_text(find_mrz_band(card), box)
+
+    def test_skewed_band(self):
+        for angle in (3, -3):
+            with self.subTest(angle=angle):
+                card, box = render_card(SPECIMEN, angle)
+                self.assert_band_holds_text(find_mrz_band(card), box)
+
+    def test_no_band(self):
+        card, _ = render_card(())
+        self.assertIsNone(find_mrz_band(card))
+
+
+@override_settings(ROLLUP_SETTLE_SECONDS=300)
+class IngestUploadTests(SimpleTestCase):
+    @staticmethod
+    def png(width, height):
+        data = BytesIO()
+        Image.new("RGB", (width, height), (200, 100, 50)).save(data, "PNG")
+        data.seek(0)
+        return data
+
+    def test_decodes_image(self):
+        image = ingest_upload(self.png(40, 20), max_side=0)
+        self.assertEqual(image.shape, (20, 40, 3))
+        self.assertEqual(tuple(image.rgb[0, 0]), (200, 100, 50))
+
+    def test_rejects_what_is_not_an_image(self):
+        with self.assertRaises(InvalidImage):
+            ingest_upload(BytesIO(b"not an image"), max_side=0)
+
+    def test_rejects_decompression_bomb(self):
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 100), self.assertRaises(InvalidImage):
+            ingest_upload(self.png(40, 20), max_side=0)
+
+
+class UpdateRollupsTests(TestCase):
+    started = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+    def commit(self, verification_id, hour, minute=0):
+        Verification.objects.create(
+            id=verification_id, timestamp=datetime(2024, 5, 1, hour, minute, tzinfo=timezone.utc), passed=True
+        )
+
+    def update(self, seconds):
+        with mock.patch("django.utils.timezone.now", return_value=self.started + timedelta(seconds=seconds)):
+            update_rollups()
+
+    def volume(self):
+        rows = report(datetime(2024, 5, 1, tzinfo=timezone.utc), datetime(2024, 5, 2, tzinfo=timezone.utc))["volume"]
+        return {row["hour"].hour: row["passed"] for row in rows}
+
+    def test_counts_new_verifications_by_hour(self):
+        self.commit(1, 10, 5)
+        self.commit(2, 11, 10)
+        self.commit(3, 11, 50)
+        self.update(0)
+        self.assertEqual(self.volume(), {10: 1, 11: 2})
+        self.update(60)
+        self.assertEqual(self.volume(), {10: 1, 11: 2})
+
+    def test_counts_records_committed_after_higher_ids(self):
+        # Writers commit in any order: 2 and 4 become visible after 3 and 5, with timestamps of earlier hours, as
+        # replayed from the audit spool
+        self.commit(1, 10, 5)
+        self.commit(3, 11, 10)
+        self.update(0)
+        self.commit(2, 9, 30)
+        self.update(120)
+        self.assertEqual(self.volume(), {9: 1, 10: 1, 11: 1})
+
+        # Settled up to 3, and no longer looked at
+        self.update(400)
+        self.commit(5, 11, 20)
+        self.update(500)
+        self.commit(4, 8, 0)
+        self.update(700)
+        self.assertEqual(self.volume(), {8: 1, 9: 1, 10: 1, 11: 2})
+
+    def test_recomputes_only_the_hours_of_new_verifications(self):
+        self.commit(1, 2, 5)
+        self.commit(2, 3, 0)
+        self.commit(3, 6, 0)
+        self.commit(4, 20, 0)
+        with mock.patch.object(analytics, "_recompute", wraps=analytics._recompute) as recompute:
+            self.update(0)
+        # The consecutive hours 2 and 3 in one range, and none of the hours between the others
+        hours = [tuple(value.hour for value in call.args) for call in recompute.call_args_list]
+        self.assertEqual(hours, [(2, 4), (6, 7), (20, 21)])
+        self.assertEqual(self.volume(), {2: 1, 3: 1, 6: 1, 20: 1})
+
+
+class FaceIndexTests(TestCase):
+    def setUp(self):
+        for name, value in (("LISTS", 16), ("FETCH_SIZE", 800)):
+            patcher = mock.patch.object(face_index, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Faces of 40 people, 20 verifications each, people about 0.9 apart and their faces within about 0.3
+        rng = np.random.default_rng(0)
+        people = rng.normal(0, 0.08, (40, face_index.ENCODING_SIZE))
+        self.faces = (np.repeat(people, 20, axis=0) + rng.normal(0, 0.02, (800, face_index.ENCODING_SIZE))).astype(
+            np.float32
+        )
+        self.store(self.faces)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = face_index.FaceIndex(directory.name, probes=2)
+        self.index.rebuild()
+        self.exact = face_index.FaceIndex(directory.name)
+
+    @staticmethod
+    def store(faces):
+        Verification.objects.bulk_create(
+            Verification(timestamp=datetime.now(timezone.utc), passed=True, face_encoding=face.tobytes())
+            for face in faces
+        )
+
+    def test_probed_search_matches_full_scan(self):
+        for face in self.faces[::37]:
+            matches = self.index.search(face, 0.45)
+            self.assertEqual(len(matches), 20)
+            self.assertEqual(matches, self.exact.search(face, 0.45))
+
+    def test_finds_faces_appended_after_rebuild(self):
+        self.store(self.faces[:1] + 0.001)
+        latest = Verification.objects.latest("id").id
+        # The database was just checked by the rebuild
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.index.search(self.faces[0], 0.45)), 20)
+        later = time.monotonic() + face_index.CATCH_UP_INTERVAL
+        with mock.patch.object(face_index.time, "monotonic", return_value=later):
+            matches = self.index.search(self.faces[0], 0.45)
+        self.assertEqual(len(matches), 21)
+        self.assertIn(latest, [verification_id for verification_id, _ in matches])
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        # File expiry is read from modification times, so the clock starts from the real time
+        self.now = time.time()
+        patcher = mock.patch("identity_verifier_app.cache.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keys_are_keyed_hashes_of_the_digest(self):
+        cache = ResultCache(60, 1000, self.directory)
+        cache.put("ocr", "digest", {"name": "ANNA"})
+        key = ResultCache.key("ocr", "digest")
+        self.assertEqual(os.listdir(self.directory), [f"{key}.json"])
+        self.assertNotIn("digest", key)
+        self.assertNotEqual(key, ResultCache.key("faces", "digest"))
+        with override_settings(SECRET_KEY="another key"):
+            self.assertNotEqual(key, ResultCache.key("ocr", "digest"))
+
+    def test_entries_expire_however_often_they_are_used(self):
+        cache = ResultCache(60, 1000)
+        cache.put("ocr", "digest", "ANNA")
+        for _ in range(5):
+            self.now += 10
+            self.assertEqual(cache.get("ocr", "digest"), "ANNA")
+        self.now += 11
+        self.assertIsNone(cache.get("ocr", "digest"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_evicts_the_least_recently_used_entry(self):
+        # Each value takes 12 bytes as JSON, so two fit
+        cache = ResultCache(60, 30)
+        cache.put("ocr", "a", "a" * 10)
+        cache.put("ocr", "b", "b" * 10)
+        cache.get("ocr", "a")
+        cache.put("ocr", "c", "c" * 10)
+        self.assertIsNone(cache.get("ocr", "b"))
+        self.assertEqual(cache.get("ocr", "a"), "a" * 10)
+        self.assertEqual(cache.get("ocr", "c"), "c" * 10)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_reads_results_another_process_wrote(self):
+        writer, reader = ResultCache(60, 1000, self.directory), ResultCache(60, 1000, self.directory)
+        writer.put("ocr", "digest", {"name": "ANNA"})
+        self.assertTrue(reader.contains("ocr", "digest"))
+        self.assertEqual(reader.get("ocr", "digest"), {"name": "ANNA"})
+        self.assertEqual(reader.stats()["disk_hits"], 1)
+
+        # Expiry counts from when the writer computed the result, also in the reader's memory
+        self.now += 61
+        self.assertIsNone(reader.get("ocr", "digest"))
+        self.assertIsNone(ResultCache(60, 1000, self.directory).get("ocr", "digest"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_prune_deletes_expired_files(self):
+        cache = ResultCache(120, 1000, self.directory)
+        cache.put("ocr", "old", "ANNA")
+        self.now += 100
+        cache.put("ocr", "new", "MARIA")
+        new = f"{ResultCache.key('ocr', 'new')}.json"
+        # As if written on the test's clock
+        os.utime(os.path.join(self.directory, new), (self.now, self.now))
+        self.now += ResultCache.PRUNE_INTERVAL
+        cache.prune()
+        self.assertEqual(os.listdir(self.directory), [new])
+
+
+class JobQueueTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = JobQueue(1, 2, 60, directory.name)
+        self.other_process = JobQueue(1, 2, 60, directory.name)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        # Jobs left blocked by a failed test would hang the test run
+        self.addCleanup(self.release.set)
+
+    def blocking_run(self, progress):
+        progress("ocr", "running")
+        self.started.set()
+        self.release.wait(5)
+        progress("ocr", "passed")
+        return 200, {"message": "Identity verified"}
+
+    def test_job_moves_from_queued_to_done(self):
+        job = self.queue.submit(self.blocking_run)
+        self.started.wait(5)
+        # The single worker is busy, so a second job waits
+        queued = self.queue.submit(lambda progress: (200, {}))
+        self.assertEqual(self.queue.get(queued.id)["status"], "queued")
+        self.assertEqual(self.queue.get(job.id)["status"], "running")
+        self.assertEqual(self.queue.get(job.id)["stages"], {"ocr": "running"})
+
+        self.release.set()
+        states = list(self.queue.watch(job.id, 5))
+        self.assertEqual(states[-1]["status"], "done")
+        self.assertEqual(states[-1]["stages"], {"ocr": "passed"})
+        self.assertEqual(states[-1]["result"], {"status_code": 200, "body": {"message": "Identity verified"}})
+        self.assertEqual(list(self.queue.watch(queued.id, 5))[-1]["status"], "done")
+        self.assertEqual(self.queue.stats()["completed"], 2)
+
+    def test_job_that_raises_fails(self):
+        def run(progress):
+            raise RuntimeError("OCR crashed")
+
+        job = self.queue.submit(run)
+        state = list(self.queue.watch(job.id, 5))[-1]
+        self.assertEqual(state["status"], "failed")
+        self.assertEqual(state["result"], {"status_code": 500, "body": {"error": "Server error"}})
+        self.assertEqual(self.queue.stats()["failed"], 1)
+
+    def test_rejects_jobs_beyond_max_pending(self):
+        jobs = [self.queue.submit(self.blocking_run), self.queue.submit(self.blocking_run)]
+        self.assertIsNone(self.queue.submit(self.blocking_run))
+        self.assertEqual(self.queue.stats()["rejected"], 1)
+        self.release.set()
+        for job in jobs:
+            list(self.queue.watch(job.id, 5))
+
+    def test_another_process_sharing_the_directory_reads_the_job(self):
+        job = self.queue.submit(self.blocking_run)
+        self.started.wait(5)
+        self.assertEqual(self.other_process.get(job.id)["status"], "running")
+
+        threading.Timer(0.1, self.release.set).start()
+        states = list(self.other_process.watch(job.id, 5))
+        self.assertEqual(states[0]["status"], "running")
+        self.assertEqual(states[-1]["status"], "done")
+        self.assertEqual(states[-1]["result"]["status_code"], 200)
+
+    def test_job_views(self):
+        job = self.queue.submit(lambda progress: (200, {"message": "Identity verified"}))
+        list(self.queue.watch(job.id, 5))
+        with mock.patch("identity_verifier_app.views.get_job_queue", return_value=self.other_process):
+            response = self.client.get(f"/api/verification-jobs/{job.id}/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["status"], "done")
+
+            response = self.client.get(f"/api/verification-jobs/{job.id}/stream/")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            events = b"".join(response.streaming_content).decode().split("\n\n")
+            self.assertEqual(json.loads(events[0][len("data: ") :])["status"], "done")
+
+            self.assertEqual(self.client.get(f"/api/verification-jobs/{'x' * 22}/").status_code, 404)
+
+
+# The audit log writes outside of any transaction, as in production, and recovers from refused inserts
+class AuditLogTests(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = AuditLog(100, 10, 0.1, directory.name)
+        self.addCleanup(self.log.close)
+
+    @staticmethod
+    def verification(last_name, **kwargs):
+        return Verification(timestamp=datetime.now(timezone.utc), passed=True, last_name=last_name, **kwargs)
+
+    @staticmethod
+    def read(directory):
+        files = sorted(entry.path for entry in os.scandir(directory) if entry.name.endswith(".json"))
+        records = []
+        for path in files:
+            with open(path) as f:
+                records.extend(item.object for item in serializers.deserialize("json", f))
+        return files, records
+
+    def test_refused_record_is_quarantined_and_the_rest_written(self):
+        Verification.objects.create(id=1000, timestamp=datetime.now(timezone.utc), passed=True, last_name="FIRST")
+        for i in range(5):
+            # The third record reuses an existing ID, which the database refuses
+            self.log.record(self.verification(f"L{i}", id=1000 if i == 2 else None))
+        self.log.close()
+
+        self.assertEqual(
+            sorted(Verification.objects.values_list("last_name", flat=True)), ["FIRST", "L0", "L1", "L3", "L4"]
+        )
+        files, records = self.read(self.log.quarantine_directory)
+        self.assertEqual(len(files), 1)
+        self.assertEqual([record.last_name for record in records], ["L2"])
+        self.assertEqual(self.read(self.log.spool_directory)[0], [])
+        stats = self.log.stats()
+        self.assertEqual((stats["written"], stats["quarantined"], stats["spooled"]), (4, 1, 0))
+
+    def test_spooled_records_are_replayed_once_the_database_is_back(self):
+        with mock.patch.object(Verification.objects, "bulk_create", side_effect=db.OperationalError("down")):
+            self.log.record(self.verification("L0"))
+            self.log.record(self.verification("L1"))
+            self.log.close()
+        # The writer thread may have spooled them in one batch or two
+        self.assertEqual([record.last_name for record in self.read(self.log.spool_directory)[1]], ["L0", "L1"])
+        self.assertFalse(Verification.objects.exists())
+
+        # The next flush writes its own batch, then the spooled one
+        self.log.record(self.verification("L2"))
+        self.log.close()
+        self.assertEqual(sorted(Verification.objects.values_list("last_name", flat=True)), ["L0", "L1", "L2"])
+        self.assertEqual(self.read(self.log.spool_directory)[0], [])
+        self.assertEqual(self.log.stats()["spooled"], 2)
+
+    def test_records_beyond_the_queue_are_spooled(self):
+        log = AuditLog(1, 10, 0.1, self.log.spool_directory)
+        # Without its writer thread, the queue fills after one record
+        with mock.patch.object(log, "_start"):
+            log.record(self.verification("L0"))
+            log.record(self.verification("L1"))
+        self.assertEqual([record.last_name for record in self.read(log.spool_directory)[1]], ["L1"])
+        self.assertEqual(log.stats()["overflowed"], 1)
+        log.close()
+        self.assertEqual(sorted(Verification.objects.values_list("last_name", flat=True)), ["L0", "L1"])
@@ -1,7 +1,19 @@
 from django.urls import path
 
-from .views import IdentityVerifier
+from .views import (
+    IdentityVerifier,
+    Readiness,
+    VerificationAnalytics,
+    VerificationJobs,
+    VerificationJobStatus,
+    VerificationJobStream,
+)
 
 urlpatterns = [
+    path("ready/", Readiness.as_view(), name="ready"),
     path("verify-identity/", IdentityVerifier.as_view(), name="verify-identity"),
+    path("verification-jobs/", VerificationJobs.as_view(), name="verification-jobs"),
+    path("verification-jobs/<str:job_id>/", VerificationJobStatus.as_view(), name="verification-job"),
+    path("verification-jobs/<str:job_id>/stream/", VerificationJobStream.as_view(), name="verification-job-stream"),
+    path("analytics/", VerificationAnalytics.as_view(), name="analytics"),
 ]
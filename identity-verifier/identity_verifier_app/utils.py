@@ -0,0 +1,48 @@
+from contextlib import contextmanager, suppress
+import functools
+import os
+import tempfile
+import threading
+from typing import IO, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w") -> Iterator[IO]:
+    """
+    Opens a temporary file in the directory of `path`, renamed to `path` when the block exits, so that other
+    processes reading `path` see the previous file or the complete new one, never a partial one. The temporary file
+    is removed if the block raises.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+def lazy(create: Callable[[], T]) -> Callable[[], T]:
+    """
+    Decorates a function creating a process-wide object into one that creates it on its first call and returns the
+    same object on every later call, from any thread.
+
+    Gunicorn imports the application before forking its workers (preload_app), and threads do not survive a fork.
+    Objects owning threads or thread pools are therefore created on first use rather than at import, and so are the
+    threads they start themselves, so that each worker process starts its own.
+    """
+    lock = threading.Lock()
+    created = []
+
+    @functools.wraps(create)
+    def get() -> T:
+        with lock:
+            if not created:
+                created.append(create())
+            return created[0]
+
+    return get
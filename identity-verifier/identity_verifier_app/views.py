@@ -1,19 +1,29 @@
-from datetime import datetime
+from datetime import datetime, time, timedelta
+import json
 import logging
-from typing import Optional, Tuple
+from typing import Optional
 
-import cv2
-import easyocr
-import face_recognition
 import numpy as np
-from PIL import Image
-import re
-from django.apps import apps
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework import status
 from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .analytics import INTERVALS, report
+from .audit import get_audit_log
+from .handoff import take_portrait, valid_portrait_token
+from .inference import models
+from .ingestion import IngestedImage, InvalidImage, ingest_array, ingest_upload
+from .jobs import get_job_queue
+from .logic import IDExtraction, verify_identity
+from .metrics import count_verification, exposition, span, trace
 from .models import Verification
 
 
@@ -21,28 +31,24 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("IdentityVerifier")
 
 
-class IDExtraction:
-    def __init__(self):
-        self.first_name = "N/A"
-        self.last_name = "N/A"
-        self.gender = "N/A"
-        self.expiration_date = "N/A"
-
-
-def build_negative_response(message) -> Response:
+def build_negative_response(message, duplicate_of: Optional[int] = None) -> Response:
     """
     Build a response where the identity verification process is considered as rejected.
     """
     now = datetime.now()
     timestamp_str = now.strftime("%d-%m-%Y %H:%M:%S")
+    count_verification("rejected", message)
     try:
-        Verification(
+        verification = Verification(
             timestamp=now,
             passed=False,
-            message=message
-        ).save()
+            message=message,
+            duplicate_of_id=duplicate_of,
+        )
+        with span("record"):
+            get_audit_log().record(verification)
     except Exception as e:
-        logger.warning(f"Failed to write verification info to database: {str(e)}")
+        logger.warning(f"Failed to record verification info: {str(e)}")
     return Response(
         {
             "verification": {
@@ -55,23 +61,36 @@ def build_negative_response(message) -> Response:
     )
 
 
-def build_positive_response(extraction: IDExtraction) -> Response:
+def build_positive_response(
+    extraction: IDExtraction, face_encoding: Optional[np.ndarray] = None, duplicate_of: Optional[int] = None
+) -> Response:
     """
     Build a response where the identity verification process is considered as passing.
     """
     now = datetime.now()
     timestamp_str = now.strftime("%d-%m-%Y %H:%M:%S")
+    count_verification("passed")
     try:
-        Verification(
+        verification = Verification(
             timestamp=now,
             passed=True,
             first_name=extraction.first_name,
             last_name=extraction.last_name,
             gender=extraction.gender,
-            document_expiration_date=extraction.expiration_date
-        ).save()
+            document_expiration_date=(
+                datetime.strptime(extraction.expiration_date, "%d.%m.%Y").date()
+                if extraction.expiration_date != "N/A"
+                else None
+            ),
+            face_encoding=(
+                np.asarray(face_encoding, dtype=np.float32).tobytes() if face_encoding is not None else None
+            ),
+            duplicate_of_id=duplicate_of,
+        )
+        with span("record"):
+            get_audit_log().record(verification)
     except Exception as e:
-        logger.warning(f"Failed to write verification info to database: {str(e)}")
+        logger.warning(f"Failed to record verification info: {str(e)}")
     return Response(
         {
             "verification": {
@@ -83,7 +102,7 @@ def build_positive_response(extraction: IDExtraction) -> Response:
                 "last_name": extraction.last_name,
                 "gender": extraction.gender,
             },
-            "document": {"expiration_date": extraction.expiration_date},
+            "document": {"expiration_date": extraction.expiration_date, "number": extraction.document_number},
         },
         status=status.HTTP_200_OK,
     )
@@ -96,11 +115,59 @@ def valid_request_parameters(id_doc_obj, portrait_obj) -> bool:
     return True
 
 
-def is_date_in_past(date_str):
-    # Convert the string to a datetime object
-    date_format = "%d.%m.%Y"  # Expected format: "DD.MM.YYYY"
-    input_date = datetime.strptime(date_str, date_format)
-    return input_date < datetime.now()
+def ingest_request_images(request):
+    """
+    Decodes the ID document and the portrait of a verification request, uploaded or handed off by the portrait
+    capturer.
+
+    Returns: <id_doc>, <portrait>, <response to give instead, or None>
+    """
+    with span("parse"):
+        # The multipart body is parsed on first access
+        request.data
+    logger.info(f"Request data: [{request.data}]")
+    logger.info(f"Request query parameters: [{request.query_params}]")
+    id_doc_obj = request.FILES.get("id_document")
+    portrait_obj = request.FILES.get("portrait")
+    # A portrait handed off by the portrait capturer can be referenced instead of uploaded
+    portrait_token = request.data.get("portrait_token")
+    if portrait_obj or not valid_portrait_token(portrait_token):
+        portrait_token = None
+
+    if not valid_request_parameters(id_doc_obj, portrait_obj or portrait_token):
+        return None, None, Response(
+            {"error": "Invalid request parameters"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    try:
+        # Each image is decoded exactly once and shared by the OCR and face steps
+        with span("decode_document"):
+            id_doc = ingest_upload(id_doc_obj)
+        if portrait_token:
+            handed_off = take_portrait(portrait_token)
+            if handed_off is None:
+                return None, None, build_negative_response("The portrait has expired, try taking another one")
+            portrait_np, metadata = handed_off
+            with span("decode_portrait"):
+                portrait = ingest_array(portrait_np, face_location=metadata.get("face_location"))
+        else:
+            with span("decode_portrait"):
+                portrait = ingest_upload(portrait_obj)
+    except InvalidImage as e:
+        logger.warning(f"Invalid image: {e}")
+        return None, None, Response(
+            {"error": "The uploaded file is not a valid image"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return id_doc, portrait, None
+
+
+def run_verification(id_doc: IngestedImage, portrait: IngestedImage, progress=None) -> Response:
+    outcome = verify_identity(id_doc, portrait, progress)
+    if not outcome.passed:
+        return build_negative_response(outcome.message, outcome.duplicate_of)
+    return build_positive_response(outcome.extraction, outcome.encoding, outcome.duplicate_of)
 
 
 class IdentityVerifier(APIView):
@@ -110,47 +177,62 @@ class IdentityVerifier(APIView):
     )   
 
     def post(self, request, *args, **kwargs):
-        logger.info(f"Request data: [{request.data}]")
-        logger.info(f"Request query parameters: [{request.query_params}]")
-        id_doc_obj = request.FILES.get("id_document")
-        portrait_obj = request.FILES.get("portrait")
+        try:
+            with trace("verify-identity"):
+                id_doc, portrait, response = ingest_request_images(request)
+                if response is not None:
+                    return response
+                return run_verification(id_doc, portrait)
 
-        if not valid_request_parameters(id_doc_obj, portrait_obj):
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            count_verification("error")
             return Response(
-                {"error": "Invalid request parameters"},
-                status=status.HTTP_400_BAD_REQUEST,
+                {"error": "Server error"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+
+def job_urls(request, job_id) -> dict:
+    return {
+        "status_url": request.build_absolute_uri(reverse("verification-job", args=[job_id])),
+        "stream_url": request.build_absolute_uri(reverse("verification-job-stream", args=[job_id])),
+    }
+
+
+class VerificationJobs(APIView):
+    """
+    Starts a verification in the background and answers at once with its job ID, so that slow verifications
+    neither hold a request open nor run into the server's timeout.
+    """
+
+    parser_classes = (
+        MultiPartParser,
+        FormParser,
+    )
+
+    def post(self, request, *args, **kwargs):
         try:
-            is_id_document, is_valid, data = self.parse_id_document(id_doc_obj)
-            if not is_id_document:
-                return build_negative_response("The uploaded file is not an ID document")
-            if not is_valid and data.expiration_date != "N/A":
-                return build_negative_response("Expired ID document")
-            if not is_valid:
-                return build_negative_response("Invalid ID document")
-            id_doc_np = face_recognition.load_image_file(id_doc_obj)
-
-            doc_faces = face_recognition.face_encodings(id_doc_np)
-            if len(doc_faces) == 0:
-                return build_negative_response("Try uploading a clearer photo of your ID document")
-            id_doc_encoding = doc_faces[0]
-            
-            portrait_np = face_recognition.load_image_file(portrait_obj)
-            portrait_faces = face_recognition.face_encodings(portrait_np)
-            # Validate portrait
-            if len(portrait_faces) == 0:
-                return build_negative_response("Try taking another portrait in better light")
-            if len(portrait_faces) > 1:
-                return build_negative_response("There is more than one person in the portrait")
-            portrait_encoding = portrait_faces[0]
-
-            if not face_recognition.compare_faces([portrait_encoding], id_doc_encoding)[
-                0
-            ]:
-                return build_negative_response("Faces do not match")
-
-            return build_positive_response(data)
+            id_doc, portrait, response = ingest_request_images(request)
+            if response is not None:
+                return response
+
+            def run(progress):
+                with trace("verification-job"):
+                    response = run_verification(id_doc, portrait, progress)
+                return response.status_code, response.data
+
+            job = get_job_queue().submit(run)
+            if job is None:
+                return Response(
+                    {"error": "Too many verifications in progress, try again later"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": str(settings.JOB_RETRY_AFTER_SECONDS)},
+                )
+            return Response(
+                {"job_id": job.id, "status": job.status, **job_urls(request, job.id)},
+                status=status.HTTP_202_ACCEPTED,
+            )
 
         except Exception as e:
             logger.error(f"Error: {e}")
@@ -159,68 +241,97 @@ class IdentityVerifier(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-    def parse_id_document(self, image_file) -> Tuple[bool, Optional[bool], Optional[IDExtraction]]:
-        """
-        Parses the text of an image of an ID document.
-        
-        Returns: <is_id_document>, <is_valid>, <extraction_data>
-        """
-        img = cv2.imdecode(np.fromstring(image_file.read(), np.uint8), cv2.IMREAD_UNCHANGED)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (3, 3), 0)
-
-        results = apps.get_app_config("identity_verifier_app").get_reader().readtext(blurred)
-        text = " ".join([result[1] for result in results])
-        text_lowered = text.lower()
-
-        keywords = [
-            "identity",
-            "identitate",
-            "carte",
-            "name",
-            "seria",
-            "nr",
-            "last name",
-            "first name",
-            "nationality",
-            "cetatenie",
-            "validity",
-            "sex",
-        ]
-        cnt_found = 0
-        for kw in keywords:
-            if kw in text_lowered:
-                cnt_found += 1
-                logger.info(f"Keyword found in document: {kw}")
-        ratio = cnt_found / len(keywords)
-        if ratio < 0.1:
-            return (False, None, None)
-
-        extraction_data = IDExtraction()
-        date = re.search(r"\d{2}\.\d{2}\.\d{2,4}-(\d{2}\.\d{2}\.\d{4})", text)
-        if date:
-            date = date.group(1)
-            logger.info(f"Document expiry date: {date}")
-            extraction_data.expiration_date = date
-
-        names = re.search(r"idrou(\w+)<+(\w+)<+", text, re.IGNORECASE)
-        if names:
-            last_name = names.group(1)
-            first_name = names.group(2)
-            logger.info(f"Name: {first_name.upper()} {last_name.upper()}")
-            extraction_data.last_name = last_name.upper()
-            extraction_data.first_name = first_name.upper()
-
-        gender = re.search(r"\s+([m|f])\s+", text, re.IGNORECASE)
-        if gender:
-            letter = gender.group(1)
-            if letter.lower() == "m":
-                gender = "MALE"
-            elif letter.lower() == "f":
-                gender = "FEMALE"
-            logger.info(f"Gender: {gender}")
-            extraction_data.gender = gender
-
-        if extraction_data.expiration_date != "N/A" and is_date_in_past(extraction_data.expiration_date):
-            return (True, False, extraction_data)
-        return (True, True, extraction_data)
\ No newline at end of file
+
+class VerificationJobStatus(APIView):
+    """
+    The state of a verification job, for clients polling it.
+    """
+
+    def get(self, request, job_id, *args, **kwargs):
+        state = get_job_queue().get(job_id)
+        if state is None:
+            return Response({"error": "Unknown verification job"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(state, status=status.HTTP_200_OK)
+
+
+class VerificationJobStream(APIView):
+    """
+    Server-sent events with the state of a verification job, one every time a stage starts or ends, until the
+    job finishes.
+    """
+
+    def get(self, request, job_id, *args, **kwargs):
+        queue = get_job_queue()
+        if queue.get(job_id) is None:
+            return Response({"error": "Unknown verification job"}, status=status.HTTP_404_NOT_FOUND)
+
+        def events():
+            for state in queue.watch(job_id, settings.JOB_STREAM_TIMEOUT_SECONDS):
+                yield f"data: {json.dumps(state)}\n\n"
+
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        return response
+
+
+class Readiness(APIView):
+    """
+    Whether the models are loaded and warmed up, with their load and warm-up times, the memory use of the
+    process and the state of its audit log queue. Answers 503 until the models are warm.
+    """
+
+    def get(self, request, *args, **kwargs):
+        state = {**models.status(), "audit": get_audit_log().stats()}
+        return Response(state, status=status.HTTP_200_OK if state["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def parse_report_time(value: str):
+    """
+    An ISO 8601 date or date and time, as an aware datetime (in TIME_ZONE if no offset is given). None if invalid.
+    """
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime.combine(day, time()) if day is not None else None
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class VerificationAnalytics(APIView):
+    """
+    Verification statistics for operations, read from the rollup tables kept by the update_rollups command, so
+    that dashboards neither scan the Verification table nor load the verification path. Staff users only.
+
+    Query parameters: `from` and `to` (ISO 8601 dates or dates and times, defaulting to the last 30 days) and
+    `interval` ("hour" or "day") for the volume.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        now = timezone.now()
+        end = parse_report_time(request.query_params["to"]) if "to" in request.query_params else now
+        start = (
+            parse_report_time(request.query_params["from"])
+            if "from" in request.query_params
+            else (end or now) - timedelta(days=30)
+        )
+        interval = request.query_params.get("interval", "hour")
+        if start is None or end is None or start >= end or interval not in INTERVALS:
+            return Response(
+                {"error": "Invalid report parameters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(report(start, end, interval), status=status.HTTP_200_OK)
+
+
+def prometheus_metrics(request):
+    """
+    Request and stage latencies, verification outcomes and the state of the caches and queues, in the Prometheus
+    text format.
+    """
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE_LATEST)
@@ -15,6 +15,7 @@ setup(
         "gunicorn",
         "psycopg2",
         "easyocr",
+        "prometheus-client",
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,102 @@
+import asyncio
+import math
+import time
+
+
+class AdmissionController:
+    """
+    Caps the sessions a process accepts, so that past its capacity new clients wait or are turned away instead of
+    every session degrading together.
+
+    A new session is admitted while there are fewer than `max_sessions` live sessions (0 means no cap) and the
+    measured detection load, plus the average load of one detecting session, fits in `cpu_budget` cores.
+    Otherwise the offer waits in a queue of at most `queue_size` offers for up to `queue_timeout` seconds.
+    """
+
+    # Time constant, in seconds, of the decaying detection load average
+    LOAD_WINDOW = 5.0
+    # How often queued offers check for capacity
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, sessions, max_sessions, cpu_budget, queue_size, queue_timeout):
+        self.sessions = sessions
+        self.max_sessions = max_sessions
+        self.cpu_budget = cpu_budget
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self._waiting = 0
+        self._busy = 0.0
+        self._busy_updated = time.monotonic()
+
+    def record_detection(self, seconds):
+        """
+        Accounts for `seconds` of detection work, as measured by the detection thread.
+        """
+        self._decay()
+        self._busy += seconds
+
+    def _decay(self):
+        now = time.monotonic()
+        self._busy *= math.exp(-(now - self._busy_updated) / self.LOAD_WINDOW)
+        self._busy_updated = now
+
+    @property
+    def load(self):
+        """
+        Detection work per second, in cores, averaged over the last few seconds.
+        """
+        self._decay()
+        return self._busy / self.LOAD_WINDOW
+
+    def detecting_sessions(self):
+        return sum(1 for session in self.sessions if session.track is not None and session.track.detecting.is_set())
+
+    def has_capacity(self):
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            return False
+        load = self.load
+        detecting = self.detecting_sessions()
+        per_session = load / detecting if detecting else 0.0
+        return load + per_session <= self.cpu_budget
+
+    async def admit(self):
+        """
+        Returns True once a new session may be created, False if it should be rejected.
+
+        The caller must create the session without awaiting in between, so that the capacity just checked is
+        still there.
+        """
+        if self.has_capacity():
+            self.admitted += 1
+            return True
+        if self._waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        self.queued += 1
+        self._waiting += 1
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.POLL_INTERVAL)
+                if self.has_capacity():
+                    self.admitted += 1
+                    return True
+        finally:
+            self._waiting -= 1
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "waiting": self._waiting,
+            "detecting_sessions": self.detecting_sessions(),
+            "detection_load": round(self.load, 3),
+            "cpu_budget": self.cpu_budget,
+        }
@@ -0,0 +1,132 @@
+import logging
+import queue
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("PortraitCapturer")
+
+
+class CascadeSet:
+    """
+    The face, eye and mouth cascades needed to validate one frame.
+
+    OpenCV's CascadeClassifier keeps per-call state, so one set must not be used by two threads at once.
+    """
+
+    def __init__(self):
+        self.face_cascade = self._load("haarcascade_frontalface_default.xml")
+        self.eye_cascade = self._load("haarcascade_eye.xml")
+        self.mouth_cascade = self._load("haarcascade_smile.xml")
+        # Side of the smallest face the face cascade can find, in the pixels of the image it runs on
+        self.face_window = self.face_cascade.getOriginalWindowSize()[0]
+
+    @staticmethod
+    def _load(filename):
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + filename)
+        if cascade.empty():
+            raise RuntimeError(f"Failed to load cascade {filename}")
+        return cascade
+
+    def detection_scale(self, width, detection_width, min_face_size):
+        """
+        Factor by which to downscale an image `width` pixels wide before running the face cascade: towards
+        `detection_width` (0 for none), but no further than a `min_face_size` face still fills the cascade's window.
+        """
+        if not detection_width or width <= detection_width:
+            return 1.0
+        return max(1.0, min(width / detection_width, min_face_size / self.face_window))
+
+    def find_faces(self, gray, detection_width, min_face_size):
+        """
+        Detects faces of at least `min_face_size` pixels over a whole grayscale frame, downscaled towards
+        `detection_width` (0 for full resolution). Returns their (x, y, w, h) boxes in full-resolution coordinates.
+        """
+        height, width = gray.shape
+        gray = cv2.equalizeHist(gray)
+        scale = self.detection_scale(width, detection_width, min_face_size)
+        if scale > 1:
+            gray = cv2.resize(gray, (round(width / scale), round(height / scale)), interpolation=cv2.INTER_AREA)
+        min_side = max(self.face_window, round(min_face_size / scale))
+        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+        return [tuple(int(round(v * scale)) for v in face) for face in faces]
+
+    def warm_up(self):
+        # The first detectMultiScale call allocates the feature evaluator buffers
+        blank = np.zeros((240, 320), dtype=np.uint8)
+        for cascade in (self.face_cascade, self.eye_cascade, self.mouth_cascade):
+            cascade.detectMultiScale(blank)
+
+
+class DetectorPool:
+    """
+    Process-wide pool of cascade sets, loaded once at startup and shared by every FaceDetectorTrack.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.load_seconds = None
+        self._available = queue.Queue()
+
+    @property
+    def loaded(self):
+        return self.load_seconds is not None
+
+    def load(self):
+        if self.loaded:
+            return
+        start = time.perf_counter()
+        for _ in range(self.size):
+            cascades = CascadeSet()
+            cascades.warm_up()
+            self._available.put(cascades)
+        self.load_seconds = time.perf_counter() - start
+        logger.info(f"Loaded {self.size} cascade set(s) in {self.load_seconds:.3f}s")
+
+    @contextmanager
+    def acquire(self):
+        """
+        Borrow a cascade set for the duration of one detection. Blocks while all sets are in use.
+        """
+        if not self.loaded:
+            raise RuntimeError("Detector pool is not loaded")
+        cascades = self._available.get()
+        try:
+            yield cascades
+        finally:
+            self._available.put(cascades)
+
+
+class FaceTracker:
+    """
+    Remembers where the face of one track was last found, so following detections only search a small window
+    around it. A full-frame search runs when the face is lost or `refresh_interval` seconds have passed.
+    """
+
+    def __init__(self, margin, refresh_interval):
+        self.margin = margin
+        self.refresh_interval = refresh_interval
+        self.box = None
+        self._last_full_search = 0
+
+    def search_window(self, width, height, now):
+        """
+        Region (x, y, w, h) to search in a width x height frame, or None if the whole frame must be searched.
+        """
+        if self.box is None or now - self._last_full_search >= self.refresh_interval:
+            return None
+        x, y, w, h = self.box
+        dx, dy = int(w * self.margin), int(h * self.margin)
+        x0, y0 = max(0, x - dx), max(0, y - dy)
+        x1, y1 = min(width, x + w + dx), min(height, y + h + dy)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def update(self, box, full_search, now):
+        """
+        Records the outcome of a search; `box` is None when no single face was found.
+        """
+        if full_search:
+            self._last_full_search = now
+        self.box = box
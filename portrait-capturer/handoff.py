@@ -0,0 +1,87 @@
+from contextlib import contextmanager, suppress
+import json
+import os
+import secrets
+import tempfile
+import time
+
+import numpy as np
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Opens a temporary binary file in the directory of `path`, renamed to `path` when the block exits, so that other
+    processes reading `path` see the previous file or the complete new one, never a partial one. The temporary file
+    is removed if the block raises.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+
+class HandoffStore:
+    """
+    Hands captured portraits over to the identity verifier through a directory both services mount.
+
+    Each portrait is stored as a raw RGB array (`<token>.npy`), so the verifier neither receives it from the
+    browser nor decodes it again. Metadata about it, such as where the face is, goes alongside in `<token>.json`.
+    Entries older than `ttl` seconds are removed, and the oldest ones are evicted when the directory holds more
+    than `max_bytes`. The verifier deletes an entry once it has read it.
+    """
+
+    def __init__(self, directory, ttl, max_bytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, rgb, metadata=None):
+        """
+        Stores an RGB portrait, and optionally a JSON serializable dict of metadata about it, and returns the token
+        they can be fetched with. Runs blocking file IO.
+        """
+        token = secrets.token_urlsafe(32)
+        # The metadata is in place before the portrait appears
+        if metadata is not None:
+            with atomic_write(os.path.join(self.directory, f"{token}.json")) as f:
+                f.write(json.dumps(metadata).encode())
+        with atomic_write(os.path.join(self.directory, f"{token}.npy")) as f:
+            np.save(f, np.ascontiguousarray(rgb), allow_pickle=False)
+        self.prune()
+        return token
+
+    def prune(self):
+        """
+        Removes expired entries, then the oldest ones while the store is over its size cap.
+        """
+        now = time.time()
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Consumed by the verifier or pruned by another worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime < self.ttl and total <= self.max_bytes:
+                break
+            for stale in (path, path[: -len(".npy")] + ".json"):
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,188 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger("PortraitCapturer")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+CAPTURE_BUCKETS = (0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+FPS_BUCKETS = (1, 5, 10, 15, 20, 25, 30, 60)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket upper bound, as Prometheus histograms keep them.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate of the q-quantile, interpolated within its bucket like Prometheus' histogram_quantile. None
+        without observations.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "sum": round(self.sum, 6),
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class PipelineMetrics:
+    """
+    Measurements of the frame pipeline of one process: frames received and skipped, detection latency and failures
+    by cascade stage, time from the start signal to the portrait being sent, the input frame rate of each session,
+    and how late the event loop runs its callbacks.
+
+    Detection runs on executor threads, so updates from there are locked.
+    """
+
+    def __init__(self):
+        self.frames_received = 0
+        self.frames_skipped = Counter()
+        self.detection_failures = Counter()
+        self.portraits_captured = 0
+        self.detection_seconds = Histogram(LATENCY_BUCKETS)
+        self.time_to_capture_seconds = Histogram(CAPTURE_BUCKETS)
+        self.session_input_fps = Histogram(FPS_BUCKETS)
+        self.event_loop_lag_seconds = Histogram(LAG_BUCKETS)
+        self._lock = threading.Lock()
+
+    def record_detection(self, seconds, failed_stage=None):
+        """
+        Called from the detection threads. `failed_stage` is the first check the frame failed ("face",
+        "multiple_faces", "eyes" or "mouth"), None if it holds a full face.
+        """
+        with self._lock:
+            self.detection_seconds.observe(seconds)
+            if failed_stage is not None:
+                self.detection_failures[failed_stage] += 1
+
+    def record_capture(self, seconds):
+        self.portraits_captured += 1
+        self.time_to_capture_seconds.observe(seconds)
+
+    async def monitor_event_loop(self, interval):
+        """
+        Measures how much later than due a sleeping task wakes up: the time callbacks wait for a busy loop.
+        """
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.event_loop_lag_seconds.observe(max(time.monotonic() - started - interval, 0.0))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "frames_received": self.frames_received,
+                "frames_skipped": dict(self.frames_skipped),
+                "detection_failures": dict(self.detection_failures),
+                "portraits_captured": self.portraits_captured,
+                "detection_seconds": self.detection_seconds.snapshot(),
+                "time_to_capture_seconds": self.time_to_capture_seconds.snapshot(),
+                "session_input_fps": self.session_input_fps.snapshot(),
+                "event_loop_lag_seconds": self.event_loop_lag_seconds.snapshot(),
+            }
+
+
+# Families rendered from the stats of each worker: (name, type, help, stats -> [(labels, value)])
+SCALAR_FAMILIES = (
+    ("sessions", "gauge", "Live sessions", lambda s: [({}, s["sessions"]["live"])]),
+    (
+        "detecting_sessions", "gauge", "Sessions looking for a face",
+        lambda s: [({}, s["admission"]["detecting_sessions"])],
+    ),
+    ("sessions_opened_total", "counter", "Sessions opened", lambda s: [({}, s["sessions"]["opened"])]),
+    ("sessions_reaped_total", "counter", "Idle or expired sessions closed", lambda s: [({}, s["sessions"]["reaped"])]),
+    (
+        "offers_total", "counter", "Offers by admission result",
+        lambda s: [({"result": result}, s["admission"][result]) for result in ("admitted", "rejected")],
+    ),
+    ("offers_queued_total", "counter", "Offers that waited for capacity", lambda s: [({}, s["admission"]["queued"])]),
+    (
+        "detection_load_cores", "gauge", "Detection work per second, in cores",
+        lambda s: [({}, s["admission"]["detection_load"])],
+    ),
+    ("frames_received_total", "counter", "Video frames received", lambda s: [({}, s["pipeline"]["frames_received"])]),
+    (
+        "frames_skipped_total", "counter", "Frames not searched for a face while detecting, by reason",
+        lambda s: [({"reason": reason}, count) for reason, count in s["pipeline"]["frames_skipped"].items()],
+    ),
+    (
+        "detection_failures_total", "counter", "Frames without a full face, by the cascade stage that failed",
+        lambda s: [({"stage": stage}, count) for stage, count in s["pipeline"]["detection_failures"].items()],
+    ),
+    ("portraits_captured_total", "counter", "Portraits sent", lambda s: [({}, s["pipeline"]["portraits_captured"])]),
+    (
+        "detector_load_seconds", "gauge", "Time the detector pool took to load and warm up its cascades",
+        lambda s: [({}, seconds) for seconds in (s["pipeline"]["detector_load_seconds"],) if seconds is not None],
+    ),
+)
+HISTOGRAM_FAMILIES = (
+    ("detection_seconds", "Latency of searching a frame for a full face"),
+    ("time_to_capture_seconds", "Time from the start signal to the portrait being sent"),
+    ("session_input_fps", "Average input frame rate of closed sessions"),
+    ("event_loop_lag_seconds", "Delay of event loop callbacks"),
+)
+
+
+def _sample(name, labels, value):
+    label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+    return f"{name}{{{label_text}}} {value}"
+
+
+def render_prometheus(workers):
+    """
+    The stats of every worker process (see server.local_stats) in the Prometheus text format, labelled by worker
+    ("main" when there is only one).
+    """
+    lines = []
+    for name, kind, help_text, samples in SCALAR_FAMILIES:
+        lines += [f"# HELP portrait_capturer_{name} {help_text}", f"# TYPE portrait_capturer_{name} {kind}"]
+        for stats in workers:
+            worker = stats["worker"] or "main"
+            for labels, value in samples(stats):
+                lines.append(_sample(f"portrait_capturer_{name}", {"worker": worker, **labels}, value))
+    for name, help_text in HISTOGRAM_FAMILIES:
+        lines += [f"# HELP portrait_capturer_{name} {help_text}", f"# TYPE portrait_capturer_{name} histogram"]
+        for stats in workers:
+            histogram = stats["pipeline"][name]
+            labels = {"worker": stats["worker"] or "main"}
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(_sample(f"portrait_capturer_{name}_bucket", {**labels, "le": bound}, cumulative))
+            lines.append(_sample(f"portrait_capturer_{name}_sum", labels, histogram["sum"]))
+            lines.append(_sample(f"portrait_capturer_{name}_count", labels, histogram["count"]))
+    return "\n".join(lines) + "\n"
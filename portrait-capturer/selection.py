@@ -0,0 +1,76 @@
+from collections import deque
+
+import cv2
+import numpy as np
+
+# Relative weight of each quality criterion in a portrait's score
+SCORE_WEIGHTS = {"sharpness": 0.4, "size": 0.2, "exposure": 0.2, "centring": 0.2}
+# Laplacian variance of a face region considered fully sharp
+SHARPNESS_REFERENCE = 400.0
+# Face width, as a fraction of the frame width, considered large enough
+SIZE_REFERENCE = 0.35
+
+
+def score_portrait(gray, box):
+    """
+    Cheap quality score in [0, 1] of a frame whose face is at `box` (x, y, w, h), from the face's sharpness,
+    its size, its exposure and how well it is centred.
+    """
+    height, width = gray.shape
+    x, y, w, h = box
+    face = gray[y : y + h, x : x + w]
+
+    sharpness = min(1.0, cv2.Laplacian(face, cv2.CV_64F).var() / SHARPNESS_REFERENCE)
+    size = min(1.0, (w / width) / SIZE_REFERENCE)
+    exposure = 1.0 - abs(float(face.mean()) - 128.0) / 128.0
+    offset = np.hypot(x + w / 2 - width / 2, y + h / 2 - height / 2)
+    centring = max(0.0, 1.0 - offset / np.hypot(width / 2, height / 2))
+
+    return (
+        SCORE_WEIGHTS["sharpness"] * sharpness
+        + SCORE_WEIGHTS["size"] * size
+        + SCORE_WEIGHTS["exposure"] * exposure
+        + SCORE_WEIGHTS["centring"] * centring
+    )
+
+
+class PortraitCandidate:
+    def __init__(self, score, frame, box):
+        self.score = score
+        self.frame = frame
+        self.box = box
+
+
+class PortraitSelector:
+    """
+    Fixed-size buffer of the frames that passed face detection. The best one is picked once a candidate reaches
+    `threshold`, or `window` seconds after the first candidate arrived.
+    """
+
+    def __init__(self, size, window, threshold):
+        self.window = window
+        self.threshold = threshold
+        self._candidates = deque(maxlen=size)
+        self._first_candidate_time = None
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def add(self, candidate, now):
+        if self._first_candidate_time is None:
+            self._first_candidate_time = now
+        self._candidates.append(candidate)
+
+    def ready(self, now):
+        if not self._candidates:
+            return False
+        if self._candidates[-1].score >= self.threshold:
+            return True
+        return now - self._first_candidate_time >= self.window
+
+    def best(self):
+        return max(self._candidates, key=lambda candidate: candidate.score)
+
+    def clear(self):
+        self._candidates.clear()
+        self._first_candidate_time = None
@@ -1,144 +1,424 @@
 import asyncio
-import base64
 import logging
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 from aiohttp import web
 from aiohttp_cors import ResourceOptions
 from aiohttp_cors import setup as cors_setup
 from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCIceCandidate, RTCConfiguration, RTCIceServer
 from av import VideoFrame
 
+from admission import AdmissionController
+from detectors import DetectorPool, FaceTracker
+from handoff import HandoffStore
+from metrics import PipelineMetrics, render_prometheus
+from sessions import SessionRegistry
+from selection import PortraitCandidate, PortraitSelector, score_portrait
+from transfer import IMAGE_FORMATS, encode_image, send_image
+from workers import WorkerRouter
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("PortraitCapturer")
 
-pcs = set()
+# Sessions idle (no video frames, data channel messages or ICE candidates) for SESSION_IDLE_TIMEOUT_SECONDS, or
+# open for longer than SESSION_MAX_LIFETIME_SECONDS, are closed every SESSION_REAP_INTERVAL_SECONDS.
+SESSION_IDLE_TIMEOUT_SECONDS = float(os.environ.get("SESSION_IDLE_TIMEOUT_SECONDS", 60))
+SESSION_MAX_LIFETIME_SECONDS = float(os.environ.get("SESSION_MAX_LIFETIME_SECONDS", 600))
+SESSION_REAP_INTERVAL_SECONDS = float(os.environ.get("SESSION_REAP_INTERVAL_SECONDS", 10))
+sessions = SessionRegistry(SESSION_IDLE_TIMEOUT_SECONDS, SESSION_MAX_LIFETIME_SECONDS)
+
+# Multi-process mode: with several Gunicorn workers (WEB_CONCURRENCY), each worker owns the sessions it answered
+# and serves an internal Unix socket in WORKER_SOCKET_DIR, through which the other workers forward signaling.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+WORKER_SOCKET_DIR = os.environ.get("WORKER_SOCKET_DIR")
+router = None
+
+# Haar cascades release the GIL inside detectMultiScale, so a small thread pool
+# keeps detection off the event loop without pickling frames to another process. The cores are split between
+# the worker processes by default.
+DETECTION_WORKERS = int(os.environ.get("DETECTION_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+detection_executor = ThreadPoolExecutor(
+    max_workers=DETECTION_WORKERS, thread_name_prefix="face-detection"
+)
+# One cascade set per detection thread, so a worker never waits for another to release its set
+detector_pool = DetectorPool(DETECTION_WORKERS)
+
+# Offers are admitted while there are fewer than MAX_SESSIONS live sessions (0 = no cap) and the measured detection
+# load, plus one more detecting session, fits in DETECTION_CPU_BUDGET cores. Other offers wait up to
+# ADMISSION_QUEUE_TIMEOUT_SECONDS in a queue of ADMISSION_QUEUE_SIZE, then get a 503 with Retry-After.
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 0))
+DETECTION_CPU_BUDGET = float(os.environ.get("DETECTION_CPU_BUDGET", DETECTION_WORKERS * 0.8))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 10))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 5))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", 5))
+admission = AdmissionController(
+    sessions, MAX_SESSIONS, DETECTION_CPU_BUDGET, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT_SECONDS
+)
+
+# Trade-off between CPU per session and time-to-capture: the face cascade runs on a copy downscaled towards
+# DETECTION_WIDTH pixels, at most DETECTION_RATE_HZ times per second. 0 disables downscaling / rate limiting.
+DETECTION_WIDTH = int(os.environ.get("DETECTION_WIDTH", 320))
+# Smallest face, in full-resolution pixels, that counts for the face checks, e.g. a second person in the frame.
+# Frames are only downscaled as far as such a face can still be detected, so raising it lets DETECTION_WIDTH apply.
+MIN_FACE_SIZE = int(os.environ.get("MIN_FACE_SIZE", 30))
+DETECTION_RATE_HZ = float(os.environ.get("DETECTION_RATE_HZ", 4))
+DETECTION_INTERVAL = 1 / DETECTION_RATE_HZ if DETECTION_RATE_HZ > 0 else 0
+# After a single face is found, following detections only search a window around it, grown by
+# TRACKING_MARGIN times the face size on each side. The whole frame is searched again when the face is lost or
+# every TRACKING_REFRESH_SECONDS, so a second person entering the frame is still caught. 0 disables tracking.
+TRACKING_MARGIN = float(os.environ.get("TRACKING_MARGIN", 0.5))
+TRACKING_REFRESH_SECONDS = float(os.environ.get("TRACKING_REFRESH_SECONDS", 2))
+# Frames that pass detection are buffered (at most CAPTURE_BUFFER_SIZE) and scored on sharpness, face size,
+# exposure and centring. The best one is sent as soon as one scores CAPTURE_SCORE_THRESHOLD (0-1), or
+# CAPTURE_WINDOW_SECONDS after the first candidate.
+CAPTURE_BUFFER_SIZE = int(os.environ.get("CAPTURE_BUFFER_SIZE", 8))
+CAPTURE_WINDOW_SECONDS = float(os.environ.get("CAPTURE_WINDOW_SECONDS", 1.5))
+CAPTURE_SCORE_THRESHOLD = float(os.environ.get("CAPTURE_SCORE_THRESHOLD", 0.85))
+# Encoding of the captured portrait and its transfer over the data channel, in PORTRAIT_CHUNK_SIZE binary chunks.
+# Sending pauses while more than PORTRAIT_BUFFER_HIGH_WATER bytes are queued on the channel.
+PORTRAIT_FORMAT = os.environ.get("PORTRAIT_FORMAT", "jpeg")
+if PORTRAIT_FORMAT not in IMAGE_FORMATS:
+    raise ValueError(f"PORTRAIT_FORMAT must be one of {', '.join(IMAGE_FORMATS)}")
+PORTRAIT_QUALITY = int(os.environ.get("PORTRAIT_QUALITY", 85))
+PORTRAIT_CHUNK_SIZE = int(os.environ.get("PORTRAIT_CHUNK_SIZE", 16 * 1024))
+PORTRAIT_BUFFER_HIGH_WATER = int(os.environ.get("PORTRAIT_BUFFER_HIGH_WATER", 256 * 1024))
+# Directory shared with the identity verifier. When set, the captured portrait is also stored there and the client
+# gets a token to verify with instead of uploading the portrait again. Entries expire after
+# PORTRAIT_HANDOFF_TTL_SECONDS, and the oldest are evicted beyond PORTRAIT_HANDOFF_MAX_BYTES.
+PORTRAIT_HANDOFF_DIR = os.environ.get("PORTRAIT_HANDOFF_DIR")
+PORTRAIT_HANDOFF_TTL_SECONDS = float(os.environ.get("PORTRAIT_HANDOFF_TTL_SECONDS", 120))
+PORTRAIT_HANDOFF_MAX_BYTES = int(os.environ.get("PORTRAIT_HANDOFF_MAX_BYTES", 256 * 1024 * 1024))
+handoff_store = (
+    HandoffStore(PORTRAIT_HANDOFF_DIR, PORTRAIT_HANDOFF_TTL_SECONDS, PORTRAIT_HANDOFF_MAX_BYTES)
+    if PORTRAIT_HANDOFF_DIR
+    else None
+)
+# Draw the detected face, eye and mouth boxes onto the returned video. Costs a colour conversion per frame.
+DETECTION_OVERLAY = os.environ.get("DETECTION_OVERLAY", "0") == "1"
+# Frame pipeline metrics, served on /metrics and /stats. The delay of the event loop is sampled every
+# EVENT_LOOP_LAG_INTERVAL_SECONDS.
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL_SECONDS", 0.5))
+pipeline_metrics = PipelineMetrics()
+
+# Pixel formats whose first plane is full-resolution luma, usable as a grayscale image as-is
+LUMA_PLANE_FORMATS = {"yuv420p", "yuvj420p", "yuv422p", "yuvj422p", "yuv444p", "yuvj444p", "nv12", "nv21"}
+
+
+def frame_to_gray(frame):
+    """
+    Grayscale view of a video frame. For YUV frames (what the decoder produces) this is the Y plane, without
+    any colour conversion or copy.
+    """
+    if frame.format.name not in LUMA_PLANE_FORMATS:
+        return frame.to_ndarray(format="gray")
+    plane = frame.planes[0]
+    luma = np.frombuffer(plane, dtype=np.uint8).reshape(plane.height, plane.line_size)
+    return luma[:, : plane.width]
 
 
 class FaceDetectorTrack(MediaStreamTrack):
     kind = "video"
 
-    def __init__(self, track):
+    def __init__(self, track, session=None):
         super().__init__()
         self.track = track
+        self.session = session
         self.data_channel = None
-        self.face_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-        )
-        self.eye_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + "haarcascade_eye.xml"
-        )
-        self.mouth_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + "haarcascade_smile.xml"
-        )
         self.frame_count = 0
         self.detecting = asyncio.Event()
+        # At most one detection per track is in flight; it always runs on the newest frame
+        self._detection = None
+        self._last_detection_time = 0
+        self._overlay_boxes = []
+        # Only touched from the detection executor, which runs one detection per track at a time
+        self._tracker = FaceTracker(TRACKING_MARGIN, TRACKING_REFRESH_SECONDS)
+        self._selector = PortraitSelector(CAPTURE_BUFFER_SIZE, CAPTURE_WINDOW_SECONDS, CAPTURE_SCORE_THRESHOLD)
+        # Input frame rate: frames received, and the moving average of the time between two of them
+        self._frames_in = 0
+        self._first_frame_time = None
+        self._last_frame_time = None
+        self._frame_interval = None
+        self._detection_started = None
+
+    @property
+    def input_fps(self):
+        return 1 / self._frame_interval if self._frame_interval else None
+
+    def start_detection(self):
+        self._detection_started = time.monotonic()
+        self.detecting.set()
+
+    def stop_detection(self):
+        self.detecting.clear()
 
     def set_data_channel(self, data_channel):
         self.data_channel = data_channel
         logger.info("Data channel set for FaceDetectorTrack")
 
-    def _is_entire_face_visible(self, img):
-        # Convert the frame to grayscale and apply histogram equalization for better detection
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.equalizeHist(gray)
+    def _find_failed_check(self, gray, boxes):
+        with detector_pool.acquire() as cascades:
+            return self._check_face(gray, cascades, self._tracker, boxes)
+
+    def _check_face(self, gray, cascades, tracker, boxes):
+        """
+        Validates a grayscale frame. Boxes of the detected face, eyes and mouth are appended to `boxes` as
+        ((x, y, w, h), colour) in full-resolution coordinates, for the overlay.
 
-        # Detect faces in the frame
-        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+        Returns the first check the frame fails ("face", "multiple_faces", "eyes" or "mouth"), None if it holds an
+        entire face.
+        """
+        # Apply histogram equalization for better detection
+        gray = cv2.equalizeHist(gray)
 
+        # Search only around the tracked face, if there is one
+        height, width = gray.shape
+        now = time.monotonic()
+        window = tracker.search_window(width, height, now)
+        if window is None:
+            wx, wy, ww, wh = 0, 0, width, height
+        else:
+            wx, wy, ww, wh = window
+        region = gray[wy : wy + wh, wx : wx + ww]
+
+        # Detect faces on a downscaled copy of the region
+        scale = cascades.detection_scale(ww, DETECTION_WIDTH, MIN_FACE_SIZE)
+        search = region
+        if scale > 1:
+            search = cv2.resize(region, (round(ww / scale), round(wh / scale)), interpolation=cv2.INTER_AREA)
+        min_side = max(cascades.face_window, round(MIN_FACE_SIZE / scale))
+        min_size, max_size = (min_side, min_side), (0, 0)
+        if window is not None:
+            # The face barely changes size between detections, which prunes most of the scale pyramid
+            tracked = tracker.box[2] / scale
+            min_size = (max(min_side, int(tracked * 0.7)),) * 2
+            max_size = (int(tracked * 1.4) + 1,) * 2
+        faces = cascades.face_cascade.detectMultiScale(search, scaleFactor=1.1, minNeighbors=5, minSize=min_size, maxSize=max_size)
+
+        # Per-frame outcomes are counted in pipeline_metrics and only logged at debug level
         if len(faces) == 0:
-            logger.info("No faces found")
-            return False
+            logger.debug("No faces found")
+            tracker.update(None, window is None, now)
+            return "face"
 
         if len(faces) > 1:
-            logger.warning(f"More than one face found: {len(faces)}")
-            return False
-        logger.info("Face: OK")
-
-        face = faces[0]
-        x, y, w, h = face
+            logger.debug(f"More than one face found: {len(faces)}")
+            tracker.update(None, window is None, now)
+            return "multiple_faces"
+        logger.debug("Face: OK")
+
+        # Scale the face box back to full resolution for the eye and mouth checks
+        x, y, w, h = (int(round(v * scale)) for v in faces[0])
+        w = min(w, ww - x)
+        h = min(h, wh - y)
+        tracker.update((wx + x, wy + y, w, h), window is None, now)
+        boxes.append(((wx + x, wy + y, w, h), (255, 0, 0)))
 
         # Define the region of interest for the face
-        face_roi = gray[y : y + h, x : x + w]
+        face_roi = region[y : y + h, x : x + w]
 
         # Detect eyes within the face region
-        eyes = self.eye_cascade.detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=10, minSize=(15, 15), flags=cv2.CASCADE_SCALE_IMAGE)
+        eyes = cascades.eye_cascade.detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=10, minSize=(15, 15), flags=cv2.CASCADE_SCALE_IMAGE)
         # Allow multiple detected eyes
         if len(eyes) < 1:
-            logger.warning(f"No eyes found")
-            return False
-        logger.info("Eyes: OK")
+            logger.debug("No eyes found")
+            return "eyes"
+        logger.debug("Eyes: OK")
+        boxes.extend(((wx + x + ex, wy + y + ey, ew, eh), (0, 255, 0)) for (ex, ey, ew, eh) in eyes)
 
         # Detect mouth within the face region (we adjust mouth region because it's typically lower on the face)
         # mouth_roi = face_roi[h//2:, :]
-        mouth = self.mouth_cascade.detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=10, minSize=(15, 15), flags=cv2.CASCADE_SCALE_IMAGE)
+        mouth = cascades.mouth_cascade.detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=10, minSize=(15, 15), flags=cv2.CASCADE_SCALE_IMAGE)
         # Allow multiple detected mouths
         if len(mouth) < 1:
-            logger.warning(f"No mouth found")
-            return False
-        logger.info("Mouth: OK")
-
-        # TODO integrate visualization with front-end
-        # Draw a rectangle around the face
-        # cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
-        # Draw rectangles around eyes and mouth
-        # roi_color = img[y:y + h, x:x + w]
-        # for (ex, ey, ew, eh) in eyes:
-        #     cv2.rectangle(roi_color, (ex, ey), (ex + ew, ey + eh), (0, 255, 0), 2)
-        # for (mx, my, mw, mh) in mouth:
-        # Ensure the mouth is detected lower on the face to avoid false positives around the nose
-        # if my > h // 2:
-        #     cv2.rectangle(roi_color, (mx, my), (mx + mw, my + mh), (0, 0, 255), 2)
-
-        return True
+            logger.debug("No mouth found")
+            return "mouth"
+        logger.debug("Mouth: OK")
+        # Only draw mouths detected lower on the face to avoid false positives around the nose
+        boxes.extend(((wx + x + mx, wy + y + my, mw, mh), (0, 0, 255)) for (mx, my, mw, mh) in mouth if my > h // 2)
+
+        return None
+
+    def _score_frame(self, frame):
+        """
+        Runs in the detection executor. Returns the frame's portrait quality score if it contains a full face
+        (otherwise None), the boxes found along the way and the time the detection took.
+        """
+        start = time.perf_counter()
+        boxes = []
+        gray = frame_to_gray(frame)
+        score = None
+        failed_check = self._find_failed_check(gray, boxes)
+        if failed_check is None:
+            # The face box is always the first one found
+            score = score_portrait(gray, boxes[0][0])
+        elapsed = time.perf_counter() - start
+        pipeline_metrics.record_detection(elapsed, failed_check)
+        return score, boxes, elapsed
+
+    @staticmethod
+    def _export_portrait(frame):
+        """
+        Runs in the detection executor. Returns the encoded portrait and, if the handoff store is enabled and could
+        store it, the token it was stored under.
+        """
+        # Only the selected frame is ever converted to colour
+        img = frame.to_ndarray(format="bgr24")
+        data = encode_image(img, PORTRAIT_FORMAT, PORTRAIT_QUALITY)
+        if not handoff_store:
+            return data, None
+
+        # The verifier uses the face location instead of detecting faces again, so the whole frame is checked for a
+        # second person once more: while tracking, detection only searched around the face. At full resolution and
+        # down to the smallest face the cascade can find, so a small face behind the subject or the photo on a
+        # held-up ID is counted as the verifier's own detection would have. A false positive only costs the
+        # verifier that detection.
+        with detector_pool.acquire() as cascades:
+            faces = cascades.find_faces(frame_to_gray(frame), 0, cascades.face_window)
+        metadata = None
+        if len(faces) == 1:
+            x, y, w, h = faces[0]
+            # face_recognition's (top, right, bottom, left)
+            metadata = {"face_location": [y, x + w, y + h, x]}
+        try:
+            token = handoff_store.put(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), metadata)
+        except OSError as e:
+            # The client then verifies with the transferred image instead
+            logger.warning(f"Failed to hand off portrait, sending it without a token: {str(e)}")
+            return data, None
+        return data, token
+
+    async def _detect(self, frame, frame_number):
+        loop = asyncio.get_running_loop()
+        try:
+            score, self._overlay_boxes, elapsed = await loop.run_in_executor(detection_executor, self._score_frame, frame)
+        except Exception as e:
+            logger.error(f"Face detection failed on frame {frame_number}: {str(e)}")
+            return
+        admission.record_detection(elapsed)
+
+        # Detection may have been stopped while the frame was being processed
+        if not self.detecting.is_set():
+            self._selector.clear()
+            return
+
+        now = time.monotonic()
+        if score is not None:
+            logger.info(f"Full face detected in frame {frame_number}, score {score:.2f}")
+            self._selector.add(PortraitCandidate(score, frame, self._overlay_boxes[0][0]), now)
+        if not self._selector.ready(now):
+            return
+
+        if not (self.data_channel and self.data_channel.readyState == "open"):
+            logger.warning(
+                "Data channel not ready, skipping face detection message and image send"
+            )
+            return
+
+        best = self._selector.best()
+        logger.info(f"Selected portrait with score {best.score:.2f} out of {len(self._selector)} candidate(s)")
+        try:
+            data, token = await loop.run_in_executor(detection_executor, self._export_portrait, best.frame)
+            self.data_channel.send("face_detected")
+            if token:
+                # The client can start verification right away, while the image is still being transferred
+                self.data_channel.send(f"portrait_token:{token}")
+            await send_image(self.data_channel, data, PORTRAIT_FORMAT, PORTRAIT_CHUNK_SIZE, PORTRAIT_BUFFER_HIGH_WATER)
+            logger.info(f"Face detection message and image ({len(data)} bytes) sent successfully")
+            if self._detection_started is not None:
+                pipeline_metrics.record_capture(time.monotonic() - self._detection_started)
+            self.detecting.clear()
+            self._selector.clear()
+            self._overlay_boxes = []
+        except Exception as e:
+            logger.error(
+                f"Failed to export or send the portrait: {str(e)}"
+            )
+
+    def _draw_overlay(self, frame):
+        """
+        Slow path for DETECTION_OVERLAY: draws the latest detection boxes onto a copy of the frame.
+        """
+        img = frame.to_ndarray(format="bgr24")
+        for (x, y, w, h), colour in self._overlay_boxes:
+            cv2.rectangle(img, (x, y), (x + w, y + h), colour, 2)
+        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame.pts = frame.pts
+        new_frame.time_base = frame.time_base
+        return new_frame
+
+    def _count_frame(self, now):
+        pipeline_metrics.frames_received += 1
+        self._frames_in += 1
+        if self._first_frame_time is None:
+            self._first_frame_time = now
+        else:
+            interval = now - self._last_frame_time
+            previous = self._frame_interval
+            self._frame_interval = interval if previous is None else 0.9 * previous + 0.1 * interval
+        self._last_frame_time = now
 
     async def recv(self):
+        frame = await self.track.recv()
+        self._count_frame(time.monotonic())
+        if self.session is not None:
+            self.session.touch()
         if not self.detecting.is_set():
-            return await self.track.recv()
+            return frame
 
         self.frame_count += 1
-        frame = await self.track.recv()
-        img = frame.to_ndarray(format="bgr24")
+        output = self._draw_overlay(frame) if DETECTION_OVERLAY else frame
 
-        # logger.info(f"Searching for faces in frame {self.frame_count}")
+        # Frames arriving while a detection is running are forwarded untouched instead of queueing behind it
+        if self._detection is not None and not self._detection.done():
+            pipeline_metrics.frames_skipped["busy"] += 1
+            return output
 
-        if self._is_entire_face_visible(img):
-            logger.info(f"Full face detected in frame {self.frame_count}")
-
-            _, buffer = cv2.imencode(".jpg", img)
-            jpg_as_text = base64.b64encode(buffer).decode("utf-8")
-
-            if self.data_channel and self.data_channel.readyState == "open":
-                try:
-                    self.data_channel.send("face_detected")
-                    self.data_channel.send(jpg_as_text)
-                    logger.info("Face detection message and image sent successfully")
-                    self.detecting.clear()
-                except Exception as e:
-                    logger.error(
-                        f"Failed to send face detection message or image: {str(e)}"
-                    )
-            else:
-                logger.warning(
-                    "Data channel not ready, skipping face detection message and image send"
-                )
+        now = time.monotonic()
+        if now - self._last_detection_time < DETECTION_INTERVAL:
+            pipeline_metrics.frames_skipped["rate_limit"] += 1
+            return output
+        self._last_detection_time = now
 
-        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-        new_frame.pts = frame.pts
-        new_frame.time_base = frame.time_base
-        return new_frame
+        # logger.info(f"Searching for faces in frame {self.frame_count}")
+
+        self._detection = asyncio.ensure_future(self._detect(frame, self.frame_count))
+        return output
+
+    def stop(self):
+        super().stop()
+        if self._detection is not None:
+            self._detection.cancel()
+        # The session's average input frame rate, counted once
+        if self._frames_in > 1 and self._last_frame_time > self._first_frame_time:
+            pipeline_metrics.session_input_fps.observe(
+                (self._frames_in - 1) / (self._last_frame_time - self._first_frame_time)
+            )
+        self._frames_in = 0
 
 
 async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
+    if not await admission.admit():
+        logger.warning("Rejecting offer: server at capacity")
+        return web.json_response(
+            {"error": "Server busy"},
+            status=503,
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+        )
+
     pc = RTCPeerConnection(configuration=RTCConfiguration([
             RTCIceServer("stun:stun.l.google.com:19302"),
             # RTCIceServer("stun:stun1.l.google.com:19302"),
         ])
     )
+    session = sessions.create(pc)
     face_detector_track = None
 
     @pc.on("datachannel")
@@ -150,21 +430,23 @@ async def offer(request):
 
         @channel.on("message")
         def on_message(message):
+            session.touch()
             if message == "start":
                 logger.info("Received start signal, beginning face detection")
                 if face_detector_track:
-                    face_detector_track.detecting.set()
+                    face_detector_track.start_detection()
             elif message == "stop":
                 logger.info("Received stop signal, stopping face detection")
                 if face_detector_track:
-                    face_detector_track.detecting.clear()
+                    face_detector_track.stop_detection()
 
     @pc.on("track")
     def on_track(track):
         logger.info(f"Track received: {track.kind}")
         if track.kind == "video":
             nonlocal face_detector_track
-            face_detector_track = FaceDetectorTrack(track)
+            face_detector_track = FaceDetectorTrack(track, session)
+            session.track = face_detector_track
             pc.addTrack(face_detector_track)
 
     @pc.on("signalingstatechange")
@@ -179,17 +461,15 @@ async def offer(request):
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
         logger.info(f"Connection state is: {pc.connectionState}")
-        if pc.connectionState == "failed":
-            await pc.close()
-            pcs.discard(pc)
+        if pc.connectionState in ("failed", "closed"):
+            await sessions.close(session.id, f"connection {pc.connectionState}")
 
     @pc.on("iceconnectionstatechange")
     async def on_iceconnectionstatechange():
         logger.info(f"ICE connection state is {pc.iceConnectionState}")
         if pc.iceConnectionState == "failed":
             logger.error("ICE connection failed")
-            await pc.close()
-            pcs.discard(pc)
+            await sessions.close(session.id, "ICE connection failed")
 
     @pc.on('icegatheringstatechange')
     async def on_icegatheringstatechange():
@@ -200,20 +480,25 @@ async def offer(request):
             # for candidate in self.ice_candidates:
             #     print('Gathered candidate:', candidate)
 
-    await pc.setRemoteDescription(offer)
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
-
-    pcs.add(pc)
+    try:
+        await pc.setRemoteDescription(offer)
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+    except Exception:
+        await sessions.close(session.id, "negotiation failed")
+        raise
 
     return web.json_response(
-        {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+        {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type, "session_id": session.id}
     )
 
 
 async def handle_ice_candidate(request):
     params = await request.json()
     print("params:", params)
+    session = sessions.get(params.get("session_id"))
+    if session is None:
+        return await forward_to_owner(request, params.get("session_id"), "/ice_candidate", params)
     candidate = RTCIceCandidate(
         component=params.get("component"),
         foundation=params.get("foundation"),
@@ -229,19 +514,110 @@ async def handle_ice_candidate(request):
         tcpType=params.get("tcpType"),
     )
     print("candidate:", candidate)
-    for pc in pcs:
-        await pc.addIceCandidate(candidate)
+    session.touch()
+    await session.pc.addIceCandidate(candidate)
     return web.Response(status=204)
 
 
+async def forward_to_owner(request, session_id, path, params):
+    """
+    Forwards a signaling request for a session this worker doesn't own to the worker that does.
+    """
+    owner = WorkerRouter.owner_of(session_id)
+    if router is None or request.app.get("internal") or owner is None or owner == router.worker_id:
+        return web.json_response({"error": "Unknown session"}, status=404)
+    result = await router.forward(owner, "POST", path, params)
+    if result is None:
+        return web.json_response({"error": "Unknown session"}, status=404)
+    status, body = result
+    return web.json_response(body, status=status) if body is not None else web.Response(status=status)
+
+
+def local_stats():
+    input_fps = (session.track.input_fps for session in sessions if session.track is not None)
+    return {
+        "worker": router.worker_id if router else None,
+        "sessions": sessions.stats(),
+        "admission": admission.stats(),
+        "pipeline": {
+            **pipeline_metrics.snapshot(),
+            # Time the detector pool took to load and warm up its cascades, None until it has
+            "detector_load_seconds": round(detector_pool.load_seconds, 3) if detector_pool.loaded else None,
+            # Current input frame rate of every live session receiving video
+            "input_fps": [round(fps, 1) for fps in input_fps if fps is not None],
+        },
+    }
+
+
+async def handle_local_stats(request):
+    return web.json_response(local_stats())
+
+
+async def all_stats():
+    """
+    local_stats of every worker process.
+    """
+    if router is None:
+        return [local_stats()]
+    workers = []
+    for worker_id in router.peers():
+        if worker_id == router.worker_id:
+            workers.append(local_stats())
+            continue
+        result = await router.forward(worker_id, "GET", "/stats")
+        if result is not None and result[0] == 200:
+            workers.append(result[1])
+    return workers
+
+
+async def handle_stats(request):
+    workers = await all_stats()
+    if router is None:
+        return web.json_response(workers[0])
+    return web.json_response({"workers": workers})
+
+
+async def handle_metrics(request):
+    return web.Response(text=render_prometheus(await all_stats()), content_type="text/plain", charset="utf-8")
+
+
+async def start_reaper(app):
+    app["reaper"] = asyncio.ensure_future(sessions.run_reaper(SESSION_REAP_INTERVAL_SECONDS))
+
+
+async def start_loop_monitor(app):
+    app["loop_monitor"] = asyncio.ensure_future(pipeline_metrics.monitor_event_loop(EVENT_LOOP_LAG_INTERVAL_SECONDS))
+
+
+async def start_router(app):
+    internal = web.Application()
+    internal["internal"] = True
+    internal.router.add_post("/ice_candidate", handle_ice_candidate)
+    internal.router.add_get("/stats", handle_local_stats)
+    await router.start(internal)
+
+
 async def on_shutdown(app):
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
-    pcs.clear()
+    app["reaper"].cancel()
+    app["loop_monitor"].cancel()
+    await sessions.close_all("server shutdown")
+    if router is not None:
+        await router.stop()
 
 
 async def app():
+    # Parse the cascade XML files once per process instead of once per connection
+    detector_pool.load()
+
     app = web.Application()
+    app.on_startup.append(start_reaper)
+    app.on_startup.append(start_loop_monitor)
+    if WORKER_SOCKET_DIR:
+        # Session IDs carry the ID of the worker owning them, for signaling to be routed back to it
+        global router
+        router = WorkerRouter(WORKER_SOCKET_DIR)
+        sessions.id_prefix = f"{router.worker_id}."
+        app.on_startup.append(start_router)
     app.on_shutdown.append(on_shutdown)
 
     cors = cors_setup(
@@ -257,6 +633,8 @@ async def app():
 
     app.router.add_post("/offer", offer)
     app.router.add_post("/ice_candidate", handle_ice_candidate)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/metrics", handle_metrics)
 
     for route in list(app.router.routes()):
         cors.add(route)
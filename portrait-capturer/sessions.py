@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import secrets
+import time
+
+logger = logging.getLogger("PortraitCapturer")
+
+
+class Session:
+    """
+    One client connection: its peer connection and, once the video arrives, its FaceDetectorTrack.
+    """
+
+    def __init__(self, session_id, pc):
+        self.id = session_id
+        self.pc = pc
+        self.track = None
+        self.created_at = time.monotonic()
+        self.last_activity = self.created_at
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+
+class SessionRegistry:
+    """
+    Live sessions by ID. Sessions idle for `idle_timeout` seconds or older than `max_lifetime` seconds are
+    closed by the reaper.
+    """
+
+    def __init__(self, idle_timeout, max_lifetime):
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        # Prepended to session IDs, e.g. to tell which worker process owns a session
+        self.id_prefix = ""
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def create(self, pc):
+        session = Session(self.id_prefix + secrets.token_urlsafe(16), pc)
+        self._sessions[session.id] = session
+        self.opened += 1
+        return session
+
+    def get(self, session_id):
+        return self._sessions.get(session_id)
+
+    async def close(self, session_id, reason):
+        """
+        Closes a session and frees its track and peer connection. Returns False if it was already closed.
+        """
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self.closed += 1
+        logger.info(f"Closing session {session_id}: {reason}")
+        if session.track is not None:
+            session.track.stop()
+        await session.pc.close()
+        return True
+
+    async def close_all(self, reason):
+        await asyncio.gather(*(self.close(session.id, reason) for session in self))
+
+    async def reap(self):
+        now = time.monotonic()
+        for session in self:
+            if now - session.created_at > self.max_lifetime:
+                reason = "maximum lifetime reached"
+            elif now - session.last_activity > self.idle_timeout:
+                reason = "idle"
+            else:
+                continue
+            if await self.close(session.id, reason):
+                self.reaped += 1
+
+    async def run_reaper(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Session reaper failed: {str(e)}")
+
+    def stats(self):
+        return {
+            "live": len(self),
+            "opened": self.opened,
+            "closed": self.closed,
+            "reaped": self.reaped,
+        }
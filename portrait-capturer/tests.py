@@ -0,0 +1,287 @@
+import asyncio
+from contextlib import contextmanager
+import os
+import socket
+import tempfile
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from av import VideoFrame
+
+from admission import AdmissionController
+import server
+from detectors import CascadeSet
+from metrics import render_prometheus
+from selection import PortraitCandidate, PortraitSelector, score_portrait
+from workers import WorkerRouter
+
+
+class CascadeSetTests(unittest.TestCase):
+    def setUp(self):
+        self.cascades = CascadeSet()
+        self.cascades.face_cascade = mock.Mock()
+        self.cascades.face_cascade.detectMultiScale.return_value = [(100, 40, 48, 48)]
+
+    def detect(self, detection_width, min_face_size):
+        faces = self.cascades.find_faces(np.zeros((720, 1280), np.uint8), detection_width, min_face_size)
+        searched, kwargs = self.cascades.face_cascade.detectMultiScale.call_args
+        return faces, searched[0].shape[1], kwargs["minSize"]
+
+    def test_downscales_only_as_far_as_the_smallest_face_stays_detectable(self):
+        # A 30-pixel face fills the cascade's 24-pixel window at 1.25x
+        faces, width, min_size = self.detect(320, 30)
+        self.assertEqual(width, 1024)
+        self.assertEqual(min_size, (24, 24))
+        self.assertEqual(faces, [(125, 50, 60, 60)])
+
+    def test_larger_smallest_face_allows_detection_width(self):
+        faces, width, min_size = self.detect(320, 120)
+        self.assertEqual(width, 320)
+        self.assertEqual(min_size, (30, 30))
+        self.assertEqual(faces, [(400, 160, 192, 192)])
+
+    def test_full_resolution(self):
+        faces, width, min_size = self.detect(0, 30)
+        self.assertEqual(width, 1280)
+        self.assertEqual(min_size, (30, 30))
+        self.assertEqual(faces, [(100, 40, 48, 48)])
+
+
+class ExportPortraitTests(unittest.TestCase):
+    def export(self, faces):
+        cascades = mock.Mock(face_window=24)
+        cascades.find_faces.return_value = faces
+
+        @contextmanager
+        def acquire():
+            yield cascades
+
+        store = mock.Mock()
+        store.put.return_value = "token"
+        frame = VideoFrame.from_ndarray(np.zeros((720, 1280, 3), np.uint8), format="bgr24")
+        with mock.patch.object(server, "handoff_store", store), mock.patch.object(
+            server.detector_pool, "acquire", acquire
+        ):
+            _, token = server.FaceDetectorTrack._export_portrait(frame)
+        self.assertEqual(token, "token")
+        # Searched at full resolution, for faces down to the cascade's window
+        self.assertEqual(cascades.find_faces.call_args[0][1:], (0, 24))
+        return store.put.call_args[0][1]
+
+    def test_hands_off_the_location_of_a_single_face(self):
+        metadata = self.export([(400, 100, 300, 300)])
+        self.assertEqual(metadata, {"face_location": [100, 700, 400, 400]})
+
+    def test_small_second_face_suppresses_the_location(self):
+        # The verifier then detects faces itself and rejects the portrait
+        self.assertIsNone(self.export([(400, 100, 300, 300), (1100, 300, 28, 28)]))
+
+
+class WorkerRouterTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_dir = directory.name
+        self.routers = [WorkerRouter(self.socket_dir) for _ in range(2)]
+        for router in self.routers:
+            await self.start(router)
+
+    async def asyncTearDown(self):
+        for router in self.routers:
+            await router.stop()
+
+    @staticmethod
+    async def start(router):
+        async def handle_ice_candidate(request):
+            params = await request.json()
+            return web.json_response({"worker": router.worker_id, "session_id": params["session_id"]})
+
+        internal = web.Application()
+        internal.router.add_post("/ice_candidate", handle_ice_candidate)
+        await router.start(internal)
+
+    async def test_signaling_reaches_the_worker_owning_the_session(self):
+        for sender in self.routers:
+            for owner in self.routers:
+                session_id = f"{owner.worker_id}.{os.urandom(8).hex()}"
+                self.assertEqual(sender.owner_of(session_id), owner.worker_id)
+                params = {"session_id": session_id}
+                result = await sender.forward(sender.owner_of(session_id), "POST", "/ice_candidate", params)
+                self.assertEqual(result, (200, {"worker": owner.worker_id, "session_id": session_id}))
+        self.assertEqual(self.routers[0].peers(), sorted(router.worker_id for router in self.routers))
+
+    async def test_worker_with_a_stale_socket_is_dropped(self):
+        # Bound but not listening, like the socket of a worker that was killed
+        stale = socket.socket(socket.AF_UNIX)
+        self.addCleanup(stale.close)
+        stale.bind(self.routers[0].socket_path("0badcafe"))
+        self.assertIn("0badcafe", self.routers[0].peers())
+
+        result = await self.routers[0].forward("0badcafe", "POST", "/ice_candidate", {"session_id": "0badcafe.1"})
+        self.assertIsNone(result)
+        self.assertEqual(self.routers[0].peers(), sorted(router.worker_id for router in self.routers))
+
+    async def test_worker_replaces_its_own_stale_socket(self):
+        router = self.routers[0]
+        await router.stop()
+        open(router.socket_path(router.worker_id), "w").close()
+        await self.start(router)
+        session_id = f"{router.worker_id}.1"
+        result = await self.routers[1].forward(router.worker_id, "POST", "/ice_candidate", {"session_id": session_id})
+        self.assertEqual(result, (200, {"worker": router.worker_id, "session_id": session_id}))
+
+
+class ScorePortraitTests(unittest.TestCase):
+    # A face a third of the width of a 640x480 frame, in its centre
+    BOX = (208, 128, 224, 224)
+
+    def frame(self, face):
+        gray = np.full((480, 640), 128, np.uint8)
+        x, y, w, h = self.BOX
+        gray[y : y + h, x : x + w] = face
+        return gray
+
+    def test_criteria(self):
+        flat = score_portrait(self.frame(128), self.BOX)
+        # Not sharp at all, but large enough (nearly), well exposed and centred
+        self.assertAlmostEqual(flat, 0.2 * (224 / 640) / 0.35 + 0.2 + 0.2)
+        # Fully sharp
+        checkers = np.indices((224, 224)).sum(axis=0) % 2 * 255
+        self.assertAlmostEqual(score_portrait(self.frame(checkers), self.BOX) - flat, 0.4, places=2)
+        # Underexposed
+        self.assertAlmostEqual(flat - score_portrait(self.frame(0), self.BOX), 0.2)
+        # In a corner
+        corner = np.full((480, 640), 128, np.uint8)
+        offset = np.hypot(320 - 112, 240 - 112) / np.hypot(320, 240)
+        self.assertAlmostEqual(flat - score_portrait(corner, (0, 0, 224, 224)), 0.2 * offset)
+
+
+class PortraitSelectorTests(unittest.TestCase):
+    def setUp(self):
+        self.selector = PortraitSelector(3, 2.0, 0.8)
+
+    def add(self, *scores, now=0.0):
+        for score in scores:
+            self.selector.add(PortraitCandidate(score, None, None), now)
+
+    def test_best_candidate_is_picked_once_one_reaches_the_threshold(self):
+        self.add(0.5, 0.7)
+        self.assertFalse(self.selector.ready(1.0))
+        self.add(0.9)
+        self.assertTrue(self.selector.ready(1.0))
+        self.assertEqual(self.selector.best().score, 0.9)
+
+    def test_best_candidate_is_picked_once_the_window_has_passed(self):
+        self.assertFalse(self.selector.ready(10.0))
+        self.add(0.5, now=1.0)
+        self.add(0.6, now=2.5)
+        self.assertFalse(self.selector.ready(2.9))
+        self.assertTrue(self.selector.ready(3.0))
+        self.assertEqual(self.selector.best().score, 0.6)
+
+    def test_oldest_candidates_are_evicted(self):
+        self.add(0.7, 0.2, 0.3, 0.4)
+        self.assertEqual(len(self.selector), 3)
+        self.assertEqual(self.selector.best().score, 0.4)
+
+    def test_clear_restarts_the_window(self):
+        self.add(0.5, now=0.0)
+        self.selector.clear()
+        self.assertEqual(len(self.selector), 0)
+        self.add(0.5, now=5.0)
+        self.assertFalse(self.selector.ready(6.0))
+        self.assertTrue(self.selector.ready(7.0))
+
+
+def detecting_session():
+    detecting = mock.Mock()
+    detecting.is_set.return_value = True
+    return SimpleNamespace(track=SimpleNamespace(detecting=detecting))
+
+
+class AdmissionControllerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sessions = []
+        self.controller = AdmissionController(self.sessions, 2, 1.0, 1, 0.5)
+        patcher = mock.patch.object(AdmissionController, "POLL_INTERVAL", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load_decays(self):
+        with mock.patch("admission.time") as clock:
+            clock.monotonic.return_value = 100.0
+            controller = AdmissionController([], 0, 1.0, 0, 0)
+            controller.record_detection(2.5)
+            self.assertAlmostEqual(controller.load, 0.5)
+            clock.monotonic.return_value += AdmissionController.LOAD_WINDOW
+            self.assertAlmostEqual(controller.load, 0.5 / np.e)
+            controller.record_detection(2.5)
+            self.assertAlmostEqual(controller.load, 0.5 / np.e + 0.5)
+
+    def test_capacity(self):
+        self.assertTrue(self.controller.has_capacity())
+        # One detecting session using 0.4 cores leaves room for another
+        self.sessions.append(detecting_session())
+        self.controller.record_detection(0.4 * AdmissionController.LOAD_WINDOW)
+        self.assertTrue(self.controller.has_capacity())
+        # Two using 0.6 together do not
+        self.sessions.append(detecting_session())
+        self.controller.record_detection(0.2 * AdmissionController.LOAD_WINDOW)
+        self.assertFalse(self.controller.has_capacity())
+        # Nor do two idle sessions, at the session cap
+        self.controller._busy = 0.0
+        self.assertFalse(self.controller.has_capacity())
+        self.sessions.pop()
+        self.assertTrue(self.controller.has_capacity())
+
+    async def test_queued_offer_is_admitted_once_capacity_frees_up(self):
+        self.sessions.extend([SimpleNamespace(track=None)] * 2)
+        waiting = asyncio.ensure_future(self.controller.admit())
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.controller.stats()["waiting"], 1)
+        # The queue holds a single offer
+        self.assertFalse(await self.controller.admit())
+        self.sessions.pop()
+        self.assertTrue(await waiting)
+        self.assertEqual(
+            {key: self.controller.stats()[key] for key in ("admitted", "queued", "rejected", "waiting")},
+            {"admitted": 1, "queued": 1, "rejected": 1, "waiting": 0},
+        )
+
+    async def test_queued_offer_is_rejected_after_the_timeout(self):
+        self.sessions.extend([SimpleNamespace(track=None)] * 2)
+        started = asyncio.get_running_loop().time()
+        self.assertFalse(await self.controller.admit())
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - started, 0.5)
+        self.assertEqual(self.controller.stats()["rejected"], 1)
+
+    async def test_rejected_offer_gets_retry_after(self):
+        app = web.Application()
+        app.router.add_post("/offer", server.offer)
+        controller = AdmissionController([SimpleNamespace(track=None)], 1, 1.0, 0, 0)
+        with mock.patch.object(server, "admission", controller):
+            async with TestClient(TestServer(app)) as client:
+                response = await client.post("/offer", json={"sdp": "", "type": "offer"})
+                self.assertEqual(response.status, 503)
+                self.assertEqual(response.headers["Retry-After"], str(server.ADMISSION_RETRY_AFTER_SECONDS))
+                self.assertEqual(await response.json(), {"error": "Server busy"})
+
+
+class StatsTests(unittest.TestCase):
+    def test_detector_load_time(self):
+        with mock.patch.object(server.detector_pool, "load_seconds", None):
+            stats = server.local_stats()
+            self.assertIsNone(stats["pipeline"]["detector_load_seconds"])
+            self.assertNotIn("portrait_capturer_detector_load_seconds{", render_prometheus([stats]))
+        with mock.patch.object(server.detector_pool, "load_seconds", 0.2504):
+            stats = server.local_stats()
+            self.assertEqual(stats["pipeline"]["detector_load_seconds"], 0.25)
+            self.assertIn('portrait_capturer_detector_load_seconds{worker="main"} 0.25\n', render_prometheus([stats]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import struct
+import zlib
+
+import cv2
+
+# Binary portrait transfer over the data channel:
+#   1. one header message: magic, protocol version, image format, total size, CRC-32 of the image, chunk size
+#   2. ceil(size / chunk size) chunk messages: chunk index followed by up to chunk size bytes of the image
+HEADER = struct.Struct("!4sBBIII")
+CHUNK_INDEX = struct.Struct("!I")
+MAGIC = b"PRTR"
+VERSION = 1
+
+# name: (format code in the header, file extension, OpenCV quality flag)
+IMAGE_FORMATS = {
+    "jpeg": (1, ".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (2, ".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def encode_image(img, image_format, quality):
+    _, extension, quality_flag = IMAGE_FORMATS[image_format]
+    ok, buffer = cv2.imencode(extension, img, [quality_flag, quality])
+    if not ok:
+        raise ValueError(f"Failed to encode image as {image_format}")
+    return buffer.tobytes()
+
+
+async def _wait_for_buffer(channel, high_water, timeout):
+    """
+    Waits until the channel's send buffer drops below its low threshold, if it is above `high_water`.
+    """
+    if channel.bufferedAmount <= high_water:
+        return
+    drained = asyncio.Event()
+    channel.once("bufferedamountlow", drained.set)
+    try:
+        await asyncio.wait_for(drained.wait(), timeout)
+    except BaseException:
+        # once() listeners remove themselves only after firing
+        if not drained.is_set():
+            channel.remove_listener("bufferedamountlow", drained.set)
+        raise
+
+
+async def send_image(channel, data, image_format, chunk_size, high_water, timeout=10):
+    """
+    Sends an encoded image over a data channel as a header followed by fixed-size binary chunks, pausing whenever
+    more than `high_water` bytes are waiting in the channel's send buffer.
+    """
+    format_code = IMAGE_FORMATS[image_format][0]
+    channel.bufferedAmountLowThreshold = high_water // 2
+    channel.send(HEADER.pack(MAGIC, VERSION, format_code, len(data), zlib.crc32(data), chunk_size))
+
+    view = memoryview(data)
+    for index, offset in enumerate(range(0, len(data), chunk_size)):
+        await _wait_for_buffer(channel, high_water, timeout)
+        if channel.readyState != "open":
+            raise ConnectionError("Data channel closed during portrait transfer")
+        channel.send(CHUNK_INDEX.pack(index) + view[offset : offset + chunk_size])
@@ -0,0 +1,88 @@
+import logging
+import os
+import re
+import secrets
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("PortraitCapturer")
+
+WORKER_ID_PATTERN = re.compile(r"^[0-9a-f]{8}$")
+
+
+class WorkerRouter:
+    """
+    Lets several worker processes on one machine serve sessions together.
+
+    A session lives in the process that answered its offer, since that process owns the peer connection and its
+    media sockets. Session IDs start with the owner's worker ID, and each worker serves an internal app on a Unix
+    socket named after its ID in `socket_dir`, so a worker receiving signaling for another worker's session can
+    forward it to the owner.
+    """
+
+    def __init__(self, socket_dir):
+        self.socket_dir = socket_dir
+        self.worker_id = secrets.token_hex(4)
+        self._runner = None
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, f"{worker_id}.sock")
+
+    @staticmethod
+    def owner_of(session_id):
+        """
+        Worker ID a session ID was issued by, or None if it is malformed.
+        """
+        worker_id, _, _ = str(session_id).partition(".")
+        return worker_id if WORKER_ID_PATTERN.match(worker_id) else None
+
+    def peers(self):
+        """
+        IDs of all workers currently serving an internal socket, including this one.
+        """
+        return sorted(
+            name[: -len(".sock")]
+            for name in os.listdir(self.socket_dir)
+            if name.endswith(".sock") and WORKER_ID_PATTERN.match(name[: -len(".sock")])
+        )
+
+    async def start(self, internal_app):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        # A socket left behind by a crashed worker of the same ID would make binding fail
+        self._unlink(self.worker_id)
+        self._runner = web.AppRunner(internal_app)
+        await self._runner.setup()
+        await web.UnixSite(self._runner, self.socket_path(self.worker_id)).start()
+        logger.info(f"Worker {self.worker_id} serving internal requests on {self.socket_path(self.worker_id)}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        self._unlink(self.worker_id)
+
+    def _unlink(self, worker_id):
+        try:
+            os.unlink(self.socket_path(worker_id))
+        except FileNotFoundError:
+            pass
+
+    async def forward(self, worker_id, method, path, json=None):
+        """
+        Sends a request to another worker's internal app. Returns (status, JSON body or None), or None if the
+        worker is unreachable. A worker whose socket refuses connections has exited without removing it, so the
+        socket is removed and the worker no longer counts among the peers.
+        """
+        connector = aiohttp.UnixConnector(path=self.socket_path(worker_id))
+        try:
+            async with aiohttp.ClientSession(connector=connector) as client:
+                async with client.request(method, f"http://worker{path}", json=json) as response:
+                    body = await response.json() if response.content_type == "application/json" else None
+                    return response.status, body
+        except (aiohttp.ClientConnectionError, FileNotFoundError) as e:
+            logger.warning(f"Worker {worker_id} is unreachable: {str(e)}")
+            if isinstance(e, aiohttp.ClientConnectorError) and isinstance(e.os_error, ConnectionRefusedError):
+                logger.warning(f"Dropping worker {worker_id}, its socket is stale")
+                self._unlink(worker_id)
+            return None
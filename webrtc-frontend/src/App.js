@@ -26,12 +26,56 @@ const options = {
   },
 };
 
+// Binary portrait transfer, see portrait-capturer/transfer.py
+const PORTRAIT_HEADER_SIZE = 18;
+const PORTRAIT_MAGIC = "PRTR";
+const PORTRAIT_FORMATS = {
+  1: { mimeType: "image/jpeg", extension: "jpg" },
+  2: { mimeType: "image/webp", extension: "webp" },
+};
+
+const CRC32_TABLE = (() => {
+  const table = new Uint32Array(256);
+  for (let n = 0; n < 256; n++) {
+    let c = n;
+    for (let k = 0; k < 8; k++) {
+      c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+    }
+    table[n] = c >>> 0;
+  }
+  return table;
+})();
+
+function crc32(bytes) {
+  let crc = 0xffffffff;
+  for (let i = 0; i < bytes.length; i++) {
+    crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xff] ^ (crc >>> 8);
+  }
+  return (crc ^ 0xffffffff) >>> 0;
+}
+
+function parsePortraitHeader(buffer) {
+  if (buffer.byteLength !== PORTRAIT_HEADER_SIZE) return null;
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== PORTRAIT_MAGIC) return null;
+  const view = new DataView(buffer);
+  return {
+    version: view.getUint8(4),
+    format: view.getUint8(5),
+    size: view.getUint32(6),
+    checksum: view.getUint32(10),
+    chunkSize: view.getUint32(14),
+  };
+}
+
 function App() {
   const docRef = useRef(null);
   const videoRef = useRef();
   const canvasRef = useRef();
   const peerConnectionRef = useRef();
   const dataChannelRef = useRef();
+  const portraitRef = useRef(null);
+  const portraitTokenRef = useRef(null);
   const ICE_GATHERING_TIMEOUT = 1000;
 
   const [isStreaming, setIsStreaming] = useState(false);
@@ -84,16 +128,59 @@ function App() {
 
     dataChannel.onopen = () => {
       console.log("Data channel is open");
+      // A portrait token is single-use, so one left from an earlier capture must never be sent again
+      portraitTokenRef.current = null;
       dataChannel.send("start");
     };
 
+    dataChannel.binaryType = "arraybuffer";
+    let transfer = null;
+
     dataChannel.onmessage = async (event) => {
       if (event.data === "face_detected") {
         console.log("Data channel: Face detected");
         setFaceDetected(true);
         setIsStreaming(false);
-      } else {
+      } else if (
+        typeof event.data === "string" &&
+        event.data.startsWith("portrait_token:")
+      ) {
+        // The portrait was handed off to the identity verifier, no need to wait for the image
+        console.log("Data channel: Portrait token received");
+        portraitTokenRef.current = event.data.slice("portrait_token:".length);
+        console.log("Sending data for identity verification");
+        const result = await verifyIdentity();
+        console.log(result);
+      } else if (event.data instanceof ArrayBuffer) {
+        if (!transfer) {
+          const header = parsePortraitHeader(event.data);
+          if (!header || !PORTRAIT_FORMATS[header.format]) {
+            console.error("Data channel: Unexpected binary message");
+            return;
+          }
+          transfer = { ...header, image: new Uint8Array(header.size), received: 0 };
+          return;
+        }
+
+        const index = new DataView(event.data).getUint32(0);
+        const chunk = new Uint8Array(event.data, 4);
+        transfer.image.set(chunk, index * transfer.chunkSize);
+        transfer.received += chunk.length;
+        if (transfer.received < transfer.size) {
+          return;
+        }
+
+        const { image, checksum, format } = transfer;
+        transfer = null;
+        if (crc32(image) !== checksum) {
+          console.error("Data channel: Portrait checksum mismatch");
+          setError("Portrait transfer failed, please try again");
+          return;
+        }
         console.log("Data channel: Frame with detection received");
+        const blob = new Blob([image], { type: PORTRAIT_FORMATS[format].mimeType });
+        portraitRef.current = { blob, extension: PORTRAIT_FORMATS[format].extension };
+
         const img = new Image();
         img.onload = () => {
           const canvas = canvasRef.current;
@@ -103,11 +190,14 @@ function App() {
             const ctx = canvas.getContext("2d");
             ctx.drawImage(img, 0, 0);
           }
+          URL.revokeObjectURL(img.src);
         };
-        img.src = "data:image/jpeg;base64," + event.data;
-        console.log("Sending data for identity verification");
-        const result = await verifyIdentity();
-        console.log(result);
+        img.src = URL.createObjectURL(blob);
+        if (!portraitTokenRef.current) {
+          console.log("Sending data for identity verification");
+          const result = await verifyIdentity();
+          console.log(result);
+        }
       }
     };
 
@@ -121,40 +211,62 @@ function App() {
     return response.blob();
   };
 
-  function canvasToBlob(canvas, mimeType = "image/jpeg", quality = 0.95) {
-    return new Promise((resolve, reject) => {
-      canvas.toBlob(
-        (blob) => {
-          if (blob) {
-            resolve(blob);
-          } else {
-            reject(new Error("Canvas to Blob conversion failed"));
-          }
-        },
-        mimeType,
-        quality
-      );
+  const isJobFinished = (job) => job.status === "done" || job.status === "failed";
+
+  const pollJob = async (statusUrl) => {
+    for (;;) {
+      const response = await fetch(statusUrl);
+      const job = await response.json();
+      if (!response.ok) return job;
+      if (isJobFinished(job)) return job.result.body;
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
+  const waitForJob = (streamUrl, statusUrl) =>
+    new Promise((resolve) => {
+      const events = new EventSource(streamUrl);
+      events.onmessage = (event) => {
+        const job = JSON.parse(event.data);
+        console.log("Verification stages:", job.stages);
+        if (isJobFinished(job)) {
+          events.close();
+          resolve(job.result.body);
+        }
+      };
+      events.onerror = () => {
+        // The stream ends after a while even if the job has not finished
+        events.close();
+        resolve(pollJob(statusUrl));
+      };
     });
-  }
 
   const verifyIdentity = async () => {
     setIsVerifying(true);
     const doc = await fetchBlob(docRef.current.fileUrl);
-    const face = await canvasToBlob(canvasRef.current);
-    console.log("Sending document file:", doc);
-    console.log("Sending face image file:", face);
     const formData = new FormData();
+    console.log("Sending document file:", doc);
     formData.append("id_document", doc, docRef.current.originalFileName);
-    formData.append("portrait", face, "portrait.jpg");
+    if (portraitTokenRef.current) {
+      console.log("Sending portrait token");
+      formData.append("portrait_token", portraitTokenRef.current);
+    } else {
+      const { blob: face, extension } = portraitRef.current;
+      console.log("Sending face image file:", face);
+      formData.append("portrait", face, `portrait.${extension}`);
+    }
     for (const [key, value] of formData) {
       const output = `${key}: ${value}\n`;
       console.log(output);
     }
-    const response = await fetch("http://localhost:8000/api/verify-identity/", {
+    // Verification runs as a background job whose progress is streamed back
+    const response = await fetch("http://localhost:8000/api/verification-jobs/", {
       method: "POST",
       body: formData,
     });
-    const result = await response.json();
+    const job = await response.json();
+    const result =
+      response.status === 202 ? await waitForJob(job.stream_url, job.status_url) : job;
     setVerificationResult(result);
     setIsVerifying(false);
     return result;
@@ -227,34 +339,47 @@ function App() {
         console.error("ICE candidate error:", event);
       };
 
+      // Candidates are routed to our session on the server, so they can only be sent once the offer is answered
+      let sessionId = null;
+      const pendingCandidates = [];
+
+      const sendIceCandidate = async (c) => {
+        try {
+          await fetch("http://localhost:8080/ice_candidate", {
+            method: "POST",
+            headers: {
+              "Content-Type": "application/json",
+            },
+            body: JSON.stringify({
+              session_id: sessionId,
+              component: c.component,
+              foundation: c.foundation,
+              ip: c.address,
+              port: c.port,
+              priority: c.priority,
+              protocol: c.protocol,
+              type: c.type,
+              relatedAddress: c.relatedAddress,
+              relatedPort: c.relatedPort,
+              sdpMid: c.sdpMid,
+              sdpMLineIndex: c.sdpMLineIndex,
+              tcpType: c.tcpType,
+            }),
+          });
+        } catch (error) {
+          console.error("Error sending ICE candidate:", error);
+        }
+      };
+
       peerConnection.onicecandidate = async (event) => {
         const c = event.candidate;
         if (c) {
-          try {
-            // console.log("ICE candidate:", c)
-            iceCandidates.push(c.toJSON());
-            await fetch("http://localhost:8080/ice_candidate", {
-              method: "POST",
-              headers: {
-                "Content-Type": "application/json",
-              },
-              body: JSON.stringify({
-                component: c.component,
-                foundation: c.foundation,
-                ip: c.address,
-                port: c.port,
-                priority: c.priority,
-                protocol: c.protocol,
-                type: c.type,
-                relatedAddress: c.relatedAddress,
-                relatedPort: c.relatedPort,
-                sdpMid: c.sdpMid,
-                sdpMLineIndex: c.sdpMLineIndex,
-                tcpType: c.tcpType,
-              }),
-            });
-          } catch (error) {
-            console.error("Error sending ICE candidate:", error);
+          // console.log("ICE candidate:", c)
+          iceCandidates.push(c.toJSON());
+          if (sessionId) {
+            await sendIceCandidate(c);
+          } else {
+            pendingCandidates.push(c);
           }
         }
       };
@@ -290,15 +415,30 @@ function App() {
         }),
       });
 
+      if (response.status === 503) {
+        // The capturer is at capacity, try again when it asks us to
+        const retryAfter = parseInt(response.headers.get("Retry-After"), 10) || 5;
+        peerConnection.close();
+        peerConnectionRef.current = null;
+        stream.getTracks().forEach((track) => track.stop());
+        setStream(null);
+        setError(`The service is busy, retrying in ${retryAfter} seconds`);
+        setTimeout(startStreaming, retryAfter * 1000);
+        return;
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
       const answer = await response.json();
       await peerConnection.setRemoteDescription(
-        new RTCSessionDescription(answer)
+        new RTCSessionDescription({ sdp: answer.sdp, type: answer.type })
       );
 
+      sessionId = answer.session_id;
+      await Promise.all(pendingCandidates.splice(0).map(sendIceCandidate));
+
       setIsStreaming(true);
     } catch (error) {
       console.error("Error starting stream:", error);